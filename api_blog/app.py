@@ -1,12 +1,27 @@
 # Import the Flask class from the flask module
+import os
+
 from flask import Flask
-import markdown
-import markdown.extensions.fenced_code
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeout
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from .auth import user_api as user_blueprint
 from .comments import comment_api as comment_blueprint
-from .models import db, BlogPost, Comment, BlogPostSchema, CommentSchema
+from .ops import ops_api as ops_blueprint
+from .commands import commands as commands_blueprint
+from .export import export_api as export_blueprint
+from .search import search_api as search_blueprint, include_object
+from .models import db, migrate, BlogPost, Comment, BlogPostSchema, CommentSchema
 from .config import app_config
+from .cache import identity_cache, response_cache
+from .hashing import hasher, HashingBusy
+from .pages import MarkdownPage
+from .pool import configure_pool, enforce_foreign_keys, is_transient
+from .profiling import profiler
+from .ratelimit import limiter, TooManyRequests, EndpointBusy, retry_after_header
+from .replicas import init_replicas
+from .tokens import tokens
+from .utils import error_response, add_cache_headers, remember_writes
 from .views import register_api
 
 
@@ -17,23 +32,79 @@ def create_app(config_name):
     app = Flask(__name__)
 
     app.config.from_object(app_config[config_name])
+    if app.config.get('PROXY_FIX_X_FOR'):
+        # the client address the rate limits are keyed by, as set by that many trusted proxies
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+    configure_pool(app)
     db.init_app(app)
-
     with app.app_context():
-        # create all tables
-        db.create_all()
+        enforce_foreign_keys(db.engine)
+    init_replicas(app)
+    migrate.init_app(app, db, directory=os.path.join(os.path.dirname(app.root_path), 'migrations'),
+                     include_object=include_object)
+    tokens.init_app(app)
+    identity_cache.init_app(app)
+    response_cache.init_app(app)
+    hasher.init_app(app)
+    profiler.init_app(app)
+    limiter.init_app(app)
+
+    if app.config.get('AUTO_CREATE_TABLES'):
+        # the schema is managed by migrations (flask db upgrade) everywhere else
+        with app.app_context():
+            db.create_all()
+
+    app.after_request(add_cache_headers)
+    app.after_request(remember_writes)
+
+    @app.errorhandler(PoolTimeout)
+    def database_unavailable(e):
+        # no free connection in time, statement timeout, lost connection or lock
+        db.session.rollback()
+        response, code = error_response('Database is busy, please try again later', code=503)
+        response.headers['Retry-After'] = '1'
+        return response, code
+
+    @app.errorhandler(OperationalError)
+    def database_error(e):
+        if is_transient(e):
+            return database_unavailable(e)
+        # a bad query or schema is a bug, a retry would fail the same way
+        db.session.rollback()
+        raise e
+
+    @app.errorhandler(HashingBusy)
+    def hashing_busy(e):
+        response, code = error_response('Server is busy, please try again later', code=503)
+        response.headers['Retry-After'] = '1'
+        return response, code
+
+    @app.errorhandler(TooManyRequests)
+    def too_many_requests(e):
+        response, code = error_response('Too many requests, please try again later', code=429)
+        response.headers['Retry-After'] = retry_after_header(e.retry_after)
+        return response, code
+
+    @app.errorhandler(EndpointBusy)
+    def endpoint_busy(e):
+        response, code = error_response('Server is busy, please try again later', code=503)
+        response.headers['Retry-After'] = '1'
+        return response, code
+
+    readme_path = app.config.get('README_PATH') or os.path.join(os.path.dirname(app.root_path), 'README.md')
+    readme = MarkdownPage(readme_path)
+    readme.refresh()
 
     @app.route("/", methods=['GET'])
     def index():
-        readme_file = open("README.md", "r")
-        md_template_string = markdown.markdown(
-            readme_file.read(), extensions=["fenced_code"]
-        )
-
-        return md_template_string
+        return readme.response()
 
     app.register_blueprint(user_blueprint, url_prefix='/users')
     app.register_blueprint(comment_blueprint, url_prefix='/post-comments')
+    app.register_blueprint(search_blueprint, url_prefix='/posts')
+    app.register_blueprint(export_blueprint)
+    app.register_blueprint(ops_blueprint)
+    app.register_blueprint(commands_blueprint)
 
     register_api(app, BlogPost, BlogPostSchema, "posts")
     register_api(app, Comment, CommentSchema, "comments")
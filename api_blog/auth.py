@@ -1,15 +1,25 @@
 from flask import request, Blueprint, jsonify, g
 from marshmallow.exceptions import ValidationError
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 
 from .models import db, User, UserSchema
-from .utils import generate_token, error_response, auth_required, pagination
+from .utils import generate_token, decode_token, error_response, auth_required, pagination, json_response, read_replica
+from .ratelimit import limiter
+from .tokens import tokens
 
 
 user_api = Blueprint('user_api', __name__)
 user_schema = UserSchema()
 
+TAKEN_MESSAGES = {
+    'email': 'User with this email already exist, please use another email.',
+    'username': 'User with this username already exist, please use another username.',
+}
+
 
 @user_api.route('/', methods=['POST'])
+@limiter.limit('auth')
 def create():
     """Create User Function"""
     try:
@@ -17,23 +27,32 @@ def create():
     except ValidationError as e:
         return error_response(e.messages)
 
-    # check if user already exist in the db
-    user = db.session.execute(db.select(User).filter_by(email=data.get('email'))).one_or_none()
-    if user:
-        message = 'User with this email already exist, please use another email.'
-        return error_response(message)
-    user = db.session.execute(db.select(User).filter_by(username=data.get('username'))).one_or_none()
-    if user:
-        message = 'User with this username already exist, please use another username.'
-        return error_response(message)
+    # one lookup for both unique columns, the unique constraints still settle concurrent signups
+    taken = db.session.execute(
+        db.select(User.email, User.username)
+        .where(or_(User.email == data.get('email'), User.username == data.get('username')))
+        .limit(2)
+    ).all()
+    # the connection goes back to the pool while the password is hashed
+    db.session.rollback()
+    if any(row.email == data.get('email') for row in taken):
+        return error_response(TAKEN_MESSAGES['email'])
+    if taken:
+        return error_response(TAKEN_MESSAGES['username'])
 
     user = User(**data)
-    user.save()
+    try:
+        user.save()
+    except IntegrityError as e:
+        db.session.rollback()
+        column = 'email' if 'email' in str(e.orig) else 'username'
+        return error_response(TAKEN_MESSAGES[column])
     token = generate_token(user.id)
     return jsonify({'jwt_token': token}), 201
 
 
 @user_api.route('/login', methods=['POST'])
+@limiter.limit('auth')
 def login():
     """User Login Function"""
     password = request.json.get('password')
@@ -52,6 +71,7 @@ def login():
             return error_response('User with this username is not found.')
     if not user or not user.check_hash(password):
         return error_response('Invalid credentials')
+    user.upgrade_hash(password)
     try:
         token = generate_token(user.id)
     except Exception:
@@ -60,15 +80,28 @@ def login():
     return jsonify({'jwt_token': token}), 200
 
 
+@user_api.route('/logout', methods=['POST'])
+@auth_required
+def logout():
+    """Revoke the token of the request until it expires"""
+    claims = decode_token(request.headers.get('api-token'))['claims']
+    if not claims.get('jti'):
+        return error_response('This token can not be revoked, it expires on its own')
+    tokens.revoke(claims)
+    return jsonify({'message': 'Logged out'}), 200
+
+
 @user_api.route('/', methods=['GET'])
+@read_replica
 @auth_required
 def get_all_users():
     """Get all users"""
     response = pagination(request, db.select(User), user_schema)
-    return jsonify(response), 200
+    return json_response(response)
 
 
 @user_api.route('/<int:user_id>', methods=['GET'])
+@read_replica
 @auth_required
 def get_user(user_id):
     """Get one single user"""
@@ -81,6 +114,7 @@ def get_user(user_id):
 
 
 @user_api.route('/me', methods=['GET'])
+@read_replica
 @auth_required
 def get_me():
     """Get my user"""
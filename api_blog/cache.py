@@ -0,0 +1,294 @@
+import json
+import math
+import bisect
+import time
+import datetime
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import current_app, request, make_response, Response, g
+from werkzeug.http import unquote_etag
+
+from .replicas import PRIMARY_COOKIE
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - redis is optional
+    redis = None
+
+
+class MemoryBackend(object):
+    """In-process LRU cache with per-entry expiry"""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._logs = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, mapping, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            for key, value in mapping.items():
+                self._data[key] = (value, expires_at)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._logs.clear()
+
+    def append(self, key, value, score, keep_after=None):
+        """Add value to the log key, ordered by score, and drop the values scored keep_after or less"""
+        with self._lock:
+            log = self._logs.setdefault(key, [])
+            bisect.insort(log, (score, value), key=lambda item: item[0])
+            if keep_after is not None:
+                del log[:bisect.bisect_right(log, keep_after, key=lambda item: item[0])]
+
+    def since(self, key, score):
+        """(value, score) of the values of the log key scored over score, in order"""
+        with self._lock:
+            log = self._logs.get(key, [])
+            return [(value, item_score) for item_score, value in
+                    log[bisect.bisect_right(log, score, key=lambda item: item[0]):]]
+
+
+class RedisBackend(object):
+    """Cache shared between workers, stored in Redis as JSON"""
+
+    def __init__(self, client, prefix='api_blog:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        if redis is None:
+            raise RuntimeError('The redis package is required for a Redis cache backend')
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl or None)
+
+    def set_many(self, mapping, ttl=None):
+        """Set every key of mapping in one round trip"""
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipeline.set(self.prefix + key, json.dumps(value), ex=ttl or None)
+        pipeline.execute()
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def append(self, key, value, score, keep_after=None):
+        pipeline = self.client.pipeline()
+        pipeline.zadd(self.prefix + key, {json.dumps(value): score})
+        if keep_after is not None:
+            pipeline.zremrangebyscore(self.prefix + key, '-inf', keep_after)
+            # the whole log goes once its newest value is past keep_after
+            pipeline.expire(self.prefix + key, max(1, math.ceil(score - keep_after)))
+        pipeline.execute()
+
+    def since(self, key, score):
+        values = self.client.zrangebyscore(self.prefix + key, f'({score}', '+inf', withscores=True)
+        return [(json.loads(value), item_score) for value, item_score in values]
+
+
+def create_backend(app, name):
+    """
+    Build the cache backend configured for name:
+    {name}_BACKEND is used as is, {name}_REDIS_URL selects Redis,
+    otherwise an in-process LRU of {name}_SIZE entries
+    """
+    backend = app.config.get(f'{name}_BACKEND')
+    if backend is not None:
+        return backend
+    redis_url = app.config.get(f'{name}_REDIS_URL')
+    if redis_url:
+        return RedisBackend.from_url(redis_url, prefix=f'api_blog:{name.lower()}:')
+    return MemoryBackend(max_size=app.config.get(f'{name}_SIZE', 10000))
+
+
+class IdentityCache(object):
+    """Verified user identities, so auth_required does not hit the users table on every request"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IDENTITY_CACHE_TTL', 300)
+        app.config.setdefault('IDENTITY_CACHE_SIZE', 10000)
+        app.extensions['identity_cache'] = create_backend(app, 'IDENTITY_CACHE')
+
+    @property
+    def backend(self):
+        return current_app.extensions['identity_cache']
+
+    def get(self, user_id):
+        return self.backend.get(f'user:{user_id}')
+
+    def set(self, user_id, identity):
+        self.backend.set(f'user:{user_id}', identity, ttl=current_app.config['IDENTITY_CACHE_TTL'])
+
+    def invalidate(self, user_id):
+        self.backend.delete(f'user:{user_id}')
+
+
+class ResponseCache(object):
+    """
+    Bodies of anonymous GET responses keyed by route and query arguments.
+    Keys embed a generation token per table and per row, writes replace the
+    tokens so older entries are never read again and expire with their TTL.
+    The tokens expire too, after RESPONSE_CACHE_GENERATION_TTL, a lost token only costs misses.
+    """
+
+    def __init__(self, app=None):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_ENABLED', True)
+        app.config.setdefault('RESPONSE_CACHE_TTL', 60)
+        app.config.setdefault('RESPONSE_CACHE_SIZE', 10000)
+        app.config.setdefault('RESPONSE_CACHE_GENERATION_TTL', 3600)
+        app.extensions['response_cache'] = create_backend(app, 'RESPONSE_CACHE')
+
+    @property
+    def backend(self):
+        return current_app.extensions['response_cache']
+
+    def _generation(self, name):
+        token = self.backend.get(f'gen:{name}')
+        if token is None:
+            token = self._new_generation(name)
+        return token
+
+    def _new_generations(self, names):
+        # a token outlives the entries keyed with it, or they would be missed before they expire
+        ttl = max(current_app.config['RESPONSE_CACHE_GENERATION_TTL'], current_app.config['RESPONSE_CACHE_TTL'])
+        tokens = {f'gen:{name}': uuid.uuid4().hex for name in names}
+        self.backend.set_many(tokens, ttl=ttl)
+        return tokens
+
+    def _new_generation(self, name):
+        return self._new_generations([name])[f'gen:{name}']
+
+    def invalidate(self, table, item_id=None):
+        """Drop the cached responses of a table, and of one of its rows when item_id is given"""
+        self.invalidate_rows(table, [] if item_id is None else [item_id])
+
+    def invalidate_rows(self, table, ids):
+        """Drop the cached responses of a table and of its rows ids, with one backend write"""
+        self._new_generations([table] + [f'{table}:{item_id}' for item_id in ids])
+
+    def _key(self, model, item_id):
+        # expanded relations are part of the response, so their tables are part of the key
+        tables = {model.__tablename__}
+        for name in request.args.get('expand', '').split(','):
+            relationship = getattr(model, name.strip(), None)
+            if hasattr(relationship, 'property') and hasattr(relationship.property, 'mapper'):
+                tables.add(relationship.property.mapper.class_.__tablename__)
+        if item_id is None:
+            generations = [self._generation(table) for table in sorted(tables)]
+        else:
+            tables.discard(model.__tablename__)
+            generations = [self._generation(f'{model.__tablename__}:{item_id}')]
+            generations += [self._generation(table) for table in sorted(tables)]
+        query = urlencode(sorted(request.args.items(multi=True)))
+        key = '|'.join([request.path, query] + generations)
+        return 'response:' + hashlib.sha1(key.encode()).hexdigest()
+
+    def cached(self, model=None):
+        """
+        Cache the response of a GET view of model, or of self.model for a MethodView.
+        A view with an id argument is invalidated by writes to that row only.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                # a client that just wrote must see its writes, a cached body may predate them
+                if (not current_app.config['RESPONSE_CACHE_ENABLED'] or request.method != 'GET'
+                        or 'api-token' in request.headers or PRIMARY_COOKIE in request.cookies):
+                    return func(*args, **kwargs)
+
+                key = self._key(model or args[0].model, kwargs.get('id'))
+                entry = self.backend.get(key)
+                if entry is not None:
+                    with self._lock:
+                        self.hits += 1
+                    etag, last_modified = entry['validators']
+                    # add_cache_headers puts the validators back on the response
+                    g.cache_validators = (etag, last_modified and datetime.datetime.fromisoformat(last_modified))
+                    if request.if_none_match.contains_weak(unquote_etag(etag)[0]):
+                        response = Response(status=304)
+                    else:
+                        response = Response(entry['body'], mimetype='application/json')
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                with self._lock:
+                    self.misses += 1
+                response = make_response(func(*args, **kwargs))
+                validators = g.get('cache_validators')
+                # a lagging replica would keep serving its rows for RESPONSE_CACHE_TTL, much longer than REPLICA_MAX_LAG
+                from_replica = current_app.extensions['sqlalchemy'].session.info.get('read_replica')
+                if response.status_code == 200 and response.is_json and validators and not from_replica:
+                    etag, last_modified = validators
+                    entry = {
+                        'body': response.get_data(as_text=True),
+                        'validators': [etag, last_modified and last_modified.isoformat()],
+                    }
+                    self.backend.set(key, entry, ttl=current_app.config['RESPONSE_CACHE_TTL'])
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return decorator
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / total if total else 0,
+        }
+
+
+identity_cache = IdentityCache()
+response_cache = ResponseCache()
@@ -0,0 +1,95 @@
+import datetime
+
+import click
+from flask import Blueprint
+from sqlalchemy import select, update, delete, exists, func
+
+from .models import db, BlogPost, Comment
+from .cache import response_cache
+
+commands = Blueprint('commands', __name__, cli_group=None)
+
+
+@commands.cli.command('repair-comment-counts')
+@click.option('--batch-size', default=1000, show_default=True, help='Posts updated per transaction.')
+def repair_comment_counts(batch_size):
+    """Recompute comment_count and last_comment_at of every blog post from the comments table"""
+    count = (select(func.count(Comment.id)).where(Comment.post_id == BlogPost.id)
+             .correlate(BlogPost).scalar_subquery())
+    last_comment_at = (select(func.max(Comment.created_at)).where(Comment.post_id == BlogPost.id)
+                       .correlate(BlogPost).scalar_subquery())
+    last_id, repaired = 0, 0
+    while True:
+        # short transactions over id ranges, so writers are never blocked for long
+        ids = db.session.scalars(
+            select(BlogPost.id).where(BlogPost.id > last_id).order_by(BlogPost.id).limit(batch_size)
+        ).all()
+        if not ids:
+            break
+        repaired_ids = db.session.scalars(
+            update(BlogPost)
+            .where(BlogPost.id.between(ids[0], ids[-1]))
+            .where((BlogPost.comment_count != count) | (BlogPost.last_comment_at.is_distinct_from(last_comment_at)))
+            .values(comment_count=count, last_comment_at=last_comment_at, updated_at=datetime.datetime.utcnow())
+            .returning(BlogPost.id)
+            .execution_options(synchronize_session=False)
+        ).all()
+        db.session.commit()
+        for post_id in repaired_ids:
+            response_cache.invalidate(BlogPost.__tablename__, post_id)
+        repaired += len(repaired_ids)
+        last_id = ids[-1]
+    click.echo(f'Repaired {repaired} blog posts')
+
+
+@commands.cli.command('cleanup-comments')
+@click.option('--batch-size', default=1000, show_default=True, help='Comments deleted per transaction.')
+@click.option('--orphans', is_flag=True, help='Also scan all comments for a missing post, which only databases '
+                                              'written before foreign keys were enforced can have.')
+def cleanup_comments(batch_size, orphans):
+    """Delete the posts marked deleted with their comments, in batches"""
+    post_ids = db.session.scalars(
+        select(BlogPost.id).where(BlogPost.deleted_at.is_not(None)).execution_options(include_deleted=True)
+    ).all()
+    comments = 0
+    for post_id in post_ids:
+        while True:
+            ids = db.session.scalars(
+                select(Comment.id).where(Comment.post_id == post_id).limit(batch_size)
+                .execution_options(include_deleted=True)
+            ).all()
+            if not ids:
+                break
+            db.session.execute(delete(Comment).where(Comment.id.in_(ids))
+                               .execution_options(include_deleted=True, synchronize_session=False))
+            db.session.commit()
+            Comment.invalidate_rows(ids)
+            comments += len(ids)
+        # nothing left to cascade
+        db.session.execute(delete(BlogPost).where(BlogPost.id == post_id)
+                           .execution_options(include_deleted=True, synchronize_session=False))
+        db.session.commit()
+
+    if orphans:
+        last_id = 0
+        while True:
+            ids = db.session.scalars(
+                select(Comment.id).where(Comment.id > last_id).order_by(Comment.id).limit(batch_size)
+            ).all()
+            if not ids:
+                break
+            orphan_ids = db.session.scalars(
+                delete(Comment)
+                .where(Comment.id.between(ids[0], ids[-1]))
+                .where(~exists().where(BlogPost.id == Comment.post_id))
+                .returning(Comment.id)
+                .execution_options(include_deleted=True, synchronize_session=False)
+            ).all()
+            db.session.commit()
+            Comment.invalidate_rows(orphan_ids)
+            comments += len(orphan_ids)
+            last_id = ids[-1]
+
+    if post_ids:
+        BlogPost.invalidate_rows(post_ids)
+    click.echo(f'Deleted {len(post_ids)} blog posts and {comments} comments')
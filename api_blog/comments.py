@@ -1,15 +1,19 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, request
 
 from .models import db, Comment, CommentSchema
-from .utils import pagination
+from .utils import pagination, expand_options, json_response, read_replica
+from .cache import response_cache
+from .ratelimit import limiter
 
 comment_api = Blueprint('comment_api', __name__)
-comment_schema = CommentSchema()
 
 
 @comment_api.route('/<int:post_id>', methods=['GET'])
+@response_cache.cached(Comment)
+@limiter.limit('read')
+@read_replica
 def get_post_comments(post_id):
     """Get all comments for specific post"""
-    comment_schema = CommentSchema()
-    response = pagination(request, db.select(Comment).filter_by(post_id=post_id), comment_schema)
-    return jsonify(response), 200
+    options, comment_schema = expand_options(request, Comment, CommentSchema, many=True)
+    response = pagination(request, db.select(Comment).filter_by(post_id=post_id).options(*options), comment_schema)
+    return json_response(response)
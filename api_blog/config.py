@@ -1,30 +1,98 @@
 import os
+import json
 from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv())
 
 
-class Dev(object):
-    """Development configuration"""
-    DEBUG = True
-    TESTING = False
-    SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
-    JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY')
+def engine_options(database_url=None):
+    """Connection pool settings of the SQLAlchemy engine, read from the environment"""
+    options = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        # seconds to wait for a free connection before failing the request with 503
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 5)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+    }
+    statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+    if statement_timeout and database_url and database_url.startswith('postgres'):
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    return options
 
 
-class Prod(object):
-    """Production configurations"""
+def concurrency_limits(threads):
+    """
+    Requests of each endpoint class let in at once per worker. By default every class stays below
+    the thread count, so the others always keep a thread, and bcrypt logins get half of them at most.
+    """
+    return {
+        'auth': int(os.getenv('CONCURRENCY_LIMIT_AUTH', max(1, threads // 2))),
+        'write': int(os.getenv('CONCURRENCY_LIMIT_WRITE', max(1, threads - 1))),
+        'read': int(os.getenv('CONCURRENCY_LIMIT_READ', max(1, threads - 1))),
+    }
+
+
+class Config(object):
+    """Settings shared by the deployed environments, read from the environment"""
     DEBUG = False
     TESTING = False
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(os.getenv('DATABASE_URL'))
+    SQLALCHEMY_REPLICA_URIS = [url for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url]
+    REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 5))
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY')
+    JWT_KEYS = json.loads(os.getenv('JWT_KEYS', '[]'))
+    JWT_ACTIVE_KID = os.getenv('JWT_ACTIVE_KID')
+    JWT_EXPIRES = int(os.getenv('JWT_EXPIRES', 86400))
+    JWT_STATELESS = os.getenv('JWT_STATELESS', 'false').lower() in ('1', 'true', 'yes')
+    TOKEN_REVOCATION_REDIS_URL = os.getenv('REDIS_URL')
+    TOKEN_REVOCATION_SYNC_INTERVAL = float(os.getenv('TOKEN_REVOCATION_SYNC_INTERVAL', 1))
+    IDENTITY_CACHE_TTL = int(os.getenv('IDENTITY_CACHE_TTL', 300))
+    IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', 10000))
+    IDENTITY_CACHE_REDIS_URL = os.getenv('REDIS_URL')
+    BCRYPT_LOG_ROUNDS = int(os.getenv('BCRYPT_LOG_ROUNDS', 10))
+    BCRYPT_POOL_WORKERS = int(os.getenv('BCRYPT_POOL_WORKERS', 2))
+    BCRYPT_POOL_MAX_PENDING = int(os.getenv('BCRYPT_POOL_MAX_PENDING', 32))
+    HTTP_CACHE_MAX_AGE = int(os.getenv('HTTP_CACHE_MAX_AGE', 0))
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 60))
+    RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 10000))
+    RESPONSE_CACHE_GENERATION_TTL = int(os.getenv('RESPONSE_CACHE_GENERATION_TTL', 3600))
+    RESPONSE_CACHE_REDIS_URL = os.getenv('REDIS_URL')
+    PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+    PROFILING_QUERY_THRESHOLD = int(os.getenv('PROFILING_QUERY_THRESHOLD', 20))
+    RATE_LIMITS = {
+        'auth': os.getenv('RATE_LIMIT_AUTH', '10/minute'),
+        'write': os.getenv('RATE_LIMIT_WRITE', '60/minute'),
+        'export': os.getenv('RATE_LIMIT_EXPORT', '10/minute'),
+    }
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+    EXPAND_LIST_LIMIT = int(os.getenv('EXPAND_LIST_LIMIT', 10))
+    RATE_LIMIT_REDIS_URL = os.getenv('REDIS_URL')
+    PROXY_FIX_X_FOR = int(os.getenv('PROXY_FIX_X_FOR', 0))
+    # threads per worker process, gunicorn.conf.py reads the same variable
+    WEB_THREADS = int(os.getenv('WEB_THREADS', 4))
+    CONCURRENCY_LIMITS = concurrency_limits(WEB_THREADS)
+
+
+class Dev(Config):
+    """Development configuration"""
+    DEBUG = True
+
+
+class Prod(Config):
+    """Production configurations"""
 
 
 class Test(object):
     """Configuration for unit test"""
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:////tmp/test.db'
+    AUTO_CREATE_TABLES = True
     JWT_SECRET_KEY = "dsjysvufy6fht"
+    BCRYPT_LOG_ROUNDS = 4
+    BCRYPT_POOL_WORKERS = 0
+    RATE_LIMIT_ENABLED = False
 
 
 app_config = {
@@ -0,0 +1,107 @@
+import io
+import csv
+import json
+import datetime
+
+from flask import Blueprint, request, current_app, stream_with_context
+from sqlalchemy import select
+
+from .models import db, BlogPost, Comment, BlogPostSchema, CommentSchema
+from .ratelimit import limiter
+from .utils import error_response, expanded_schema, row_fields, dump_rows, read_replica
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+export_api = Blueprint('export_api', __name__)
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+# id filters accepted by the export of each model, besides since, until and after
+FILTERS = {BlogPost: ('author_id',), Comment: ('author_id', 'post_id')}
+
+
+def export_select(model, args):
+    """
+    Columns of the rows of model matching the filters of args, in id order.
+    after=<id> resumes an export after the last row received. Raises ValueError for an invalid filter.
+    """
+    statement = select(model).order_by(model.id)
+    for name in FILTERS[model]:
+        if name in args:
+            statement = statement.where(getattr(model, name) == int(args[name]))
+    if 'since' in args:
+        statement = statement.where(model.created_at >= datetime.datetime.fromisoformat(args['since']))
+    if 'until' in args:
+        statement = statement.where(model.created_at < datetime.datetime.fromisoformat(args['until']))
+    if 'after' in args:
+        statement = statement.where(model.id > int(args['after']))
+    return statement
+
+
+def ndjson_chunks(partitions, names):
+    for rows in partitions:
+        items = dump_rows(rows, names)
+        if orjson is not None:
+            yield b''.join(orjson.dumps(item) + b'\n' for item in items)
+        else:
+            yield ''.join(json.dumps(item) + '\n' for item in items)
+
+
+def csv_chunks(partitions, names):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([key for key, _ in names])
+    for rows in partitions:
+        writer.writerows([value.isoformat() if isinstance(value, datetime.datetime) else value for value in row]
+                         for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # the header of an empty export
+        yield buffer.getvalue()
+
+
+def export(model, schema_class, name):
+    """
+    Stream the rows of model as NDJSON or CSV. The rows are fetched from a server-side cursor
+    EXPORT_BATCH_SIZE at a time and written out batch by batch, so memory does not grow with the export.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in FORMATS:
+        return error_response(f"Unknown format, use one of {', '.join(FORMATS)}.")
+    try:
+        statement = export_select(model, request.args)
+    except ValueError:
+        return error_response('Invalid filter, ids are integers and dates ISO 8601.')
+    names = row_fields(model, expanded_schema(schema_class))
+    statement = statement.with_only_columns(*[getattr(model, attribute) for _, attribute in names])
+    batch_size = current_app.config.get('EXPORT_BATCH_SIZE', 1000)
+
+    def partitions():
+        result = db.session.execute(statement.execution_options(yield_per=batch_size))
+        yield from result.partitions()
+
+    chunks = ndjson_chunks if export_format == 'ndjson' else csv_chunks
+    response = current_app.response_class(stream_with_context(chunks(partitions(), names)),
+                                          mimetype=FORMATS[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename={name}.{export_format}'
+    return response
+
+
+@export_api.route('/posts/export', methods=['GET'])
+@limiter.limit('export')
+@read_replica
+def export_posts():
+    """Export blog posts, filtered by author_id, since and until"""
+    return export(BlogPost, BlogPostSchema, 'posts')
+
+
+@export_api.route('/comments/export', methods=['GET'])
+@limiter.limit('export')
+@read_replica
+def export_comments():
+    """Export comments, filtered by author_id, post_id, since and until"""
+    return export(Comment, CommentSchema, 'comments')
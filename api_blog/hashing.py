@@ -0,0 +1,179 @@
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+from flask import current_app, after_this_request
+
+from .profiling import timed
+
+
+class HashingBusy(Exception):
+    """Raised when too many password hashes are already in progress"""
+
+
+def _encode(password):
+    # bcrypt only uses the first 72 bytes and newer releases refuse longer input
+    return password.encode('utf-8')[:72]
+
+
+def _generate_hash(password, rounds):
+    return bcrypt.hashpw(_encode(password), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check_hash(pw_hash, password):
+    return bcrypt.checkpw(_encode(password), pw_hash.encode('utf-8'))
+
+
+def hash_rounds(pw_hash):
+    """Return the cost factor a bcrypt hash was made with"""
+    try:
+        return int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class HashPool(object):
+    """
+    Runs bcrypt in a process pool with a bound on pending jobs.
+    With no workers the hash runs on the calling thread, still bounded.
+    """
+
+    def __init__(self, workers=0, max_pending=32):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        # Created on first use so that preforked servers start it in every worker. The worker
+        # serves requests on several threads, forking it could copy a lock another thread holds
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('forkserver'))
+            return self._executor
+
+    def _replace_broken(self, executor):
+        """Drop a pool whose process died, the next hash starts a new one"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _acquire(self):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+
+    def run(self, func, *args):
+        self._acquire()
+        try:
+            if not self.workers:
+                return func(*args)
+            executor = self.executor
+            try:
+                return executor.submit(func, *args).result()
+            except BrokenProcessPool:
+                self._replace_broken(executor)
+                raise HashingBusy()
+        finally:
+            self._slots.release()
+
+    def submit(self, func, *args, callback=None):
+        """Run func in the pool and pass its result to callback, without waiting for it"""
+        self._acquire()
+        executor = None
+        try:
+            executor = self.executor
+            future = executor.submit(func, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._replace_broken(executor)
+            raise HashingBusy()
+        except BaseException:
+            self._slots.release()
+            raise
+
+        def done(future):
+            self._slots.release()
+            if isinstance(future.exception(), BrokenProcessPool):
+                self._replace_broken(executor)
+            elif future.exception() is None:
+                callback(future.result())
+
+        future.add_done_callback(done)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+class PasswordHasher(object):
+    """bcrypt password hashing off the request thread"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 10)
+        app.config.setdefault('BCRYPT_POOL_WORKERS', 0)
+        app.config.setdefault('BCRYPT_POOL_MAX_PENDING', 32)
+        app.extensions['password_hasher'] = HashPool(
+            workers=app.config['BCRYPT_POOL_WORKERS'],
+            max_pending=app.config['BCRYPT_POOL_MAX_PENDING'],
+        )
+
+    @property
+    def pool(self):
+        return current_app.extensions['password_hasher']
+
+    def generate_hash(self, password):
+        with timed('bcrypt'):
+            return self.pool.run(_generate_hash, password, current_app.config['BCRYPT_LOG_ROUNDS'])
+
+    def check_hash(self, pw_hash, password):
+        if not pw_hash:
+            return False
+        if isinstance(pw_hash, bytes):
+            pw_hash = pw_hash.decode('utf-8')
+        with timed('bcrypt'):
+            return self.pool.run(_check_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        if isinstance(pw_hash, bytes):
+            pw_hash = pw_hash.decode('utf-8')
+        return hash_rounds(pw_hash) != current_app.config['BCRYPT_LOG_ROUNDS']
+
+    def rehash_later(self, password, callback):
+        """
+        Hash password with the configured rounds and pass the result to callback
+        once the response is sent. The upgrade is skipped if the pool is busy,
+        it is retried on the next login.
+        """
+        rounds = current_app.config['BCRYPT_LOG_ROUNDS']
+        pool = self.pool
+        if pool.workers:
+            try:
+                pool.submit(_generate_hash, password, rounds, callback=callback)
+            except HashingBusy:
+                pass
+            return
+
+        def rehash():
+            try:
+                callback(pool.run(_generate_hash, password, rounds))
+            except HashingBusy:
+                pass
+
+        @after_this_request
+        def rehash_on_close(response):
+            response.call_on_close(rehash)
+            return response
+
+
+hasher = PasswordHasher()
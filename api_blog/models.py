@@ -1,51 +1,192 @@
 import datetime
+from collections import Counter
+from contextlib import contextmanager
 
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey
-from sqlalchemy.orm import relationship, DeclarativeBase
-from flask_bcrypt import Bcrypt
+from flask_migrate import Migrate
+from sqlalchemy import (Column, Integer, String, DateTime, Text, ForeignKey, Index, insert, event, select, update, delete,
+                        func, text)
+from sqlalchemy.orm import relationship, DeclarativeBase, Session, with_loader_criteria
+from sqlalchemy.orm.attributes import get_history
 from marshmallow import fields, Schema
 
+from .cache import identity_cache, response_cache
+from .hashing import hasher
+from .replicas import RoutingSession
+from .tokens import tokens
+
 
 class Base(DeclarativeBase):
     pass
 
 
-bcrypt = Bcrypt()
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={'class_': RoutingSession})
+migrate = Migrate()
 
 Base.query = db.session.query_property()
 
 
+@contextmanager
+def unit_of_work():
+    """
+    Make the writes of the block one transaction: save, update, delete and the *_where
+    methods called inside it leave the commit to the end of the block, so the changes are
+    flushed together and committed once. Cached responses are invalidated after the commit.
+    Objects added in the block get their id on the next flush (any query flushes first).
+    """
+    if 'unit_of_work' in db.session.info:
+        # nested blocks are part of the outer one
+        yield
+        return
+    pending = db.session.info['unit_of_work'] = []
+    try:
+        yield
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.info.pop('unit_of_work', None)
+    for callback in pending:
+        callback()
+
+
+def commit():
+    """Commit now, unless an enclosing unit_of_work commits later"""
+    if 'unit_of_work' not in db.session.info:
+        db.session.commit()
+
+
+def after_commit(callback):
+    """Run callback once the enclosing unit_of_work committed, or right away outside of one"""
+    pending = db.session.info.get('unit_of_work')
+    if pending is None:
+        callback()
+    else:
+        pending.append(callback)
+
+
 class BaseMixin(object):
     created_at = Column(DateTime)
+    updated_at = Column(DateTime)
 
     def __init__(self, **kwargs):
         self.created_at = datetime.datetime.utcnow()
+        self.updated_at = self.created_at
 
     def save(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
+        after_commit(self.invalidate)
+
+    def invalidate(self):
+        """Drop the cached responses showing this object, once it is committed"""
+        response_cache.invalidate(self.__tablename__, self.id)
 
     def update(self, data):
         for key, item in data.items():
             if key == 'password':
                 self.password = self.generate_hash(data.get('password'))
             setattr(self, key, item)
-        db.session.commit()
+        self.updated_at = datetime.datetime.utcnow()
+        commit()
+        after_commit(self.invalidate)
 
     def delete(self):
+        item_id = self.id
         db.session.delete(self)
-        db.session.commit()
+        commit()
+        after_commit(lambda: response_cache.invalidate(self.__tablename__, item_id))
+
+    @classmethod
+    def invalidate_rows(cls, ids):
+        response_cache.invalidate_rows(cls.__tablename__, ids)
+
+    @classmethod
+    def update_where(cls, *criteria, **values):
+        """Set values on the rows matching criteria with one UPDATE, without loading them. Return their ids."""
+        return [row.id for row in cls.update_returning(*criteria, **values)]
+
+    @classmethod
+    def update_returning(cls, *criteria, **values):
+        """update_where returning the updated rows, with all their columns"""
+        values.setdefault('updated_at', datetime.datetime.utcnow())
+        if 'version' in cls.__table__.c:
+            values.setdefault('version', cls.version + 1)
+        rows = db.session.execute(update(cls).where(*criteria).values(**values).returning(*cls.__table__.c)).all()
+        commit()
+        ids = [row.id for row in rows]
+        after_commit(lambda: cls.invalidate_rows(ids))
+        return rows
+
+    @classmethod
+    def delete_where(cls, *criteria):
+        """Delete the rows matching criteria with one DELETE, without loading them. Return their ids."""
+        ids = db.session.scalars(delete(cls).where(*criteria).returning(cls.id)).all()
+        commit()
+        after_commit(lambda: cls.invalidate_rows(ids))
+        return ids
+
+    @classmethod
+    def bulk_create(cls, items):
+        """Insert many rows with one executemany in a single transaction, return their ids"""
+        now = datetime.datetime.utcnow()
+        rows = [dict(item, created_at=now, updated_at=now) for item in items]
+        ids = db.session.scalars(insert(cls).returning(cls.id, sort_by_parameter_order=True), rows).all()
+        cls.after_bulk_create(items)
+        commit()
+        after_commit(lambda: response_cache.invalidate(cls.__tablename__))
+        return ids
+
+    @classmethod
+    def missing_references(cls, items):
+        """
+        Errors of the items, by index, whose foreign keys point to no row (or to a post marked deleted).
+        One IN query per foreign key for all the items.
+        """
+        errors = {}
+        for foreign_key in cls.__table__.foreign_keys:
+            name = foreign_key.parent.key
+            values = {item[name] for item in items.values() if item.get(name) is not None}
+            if not values:
+                continue
+            target = next(mapper.class_ for mapper in Base.registry.mappers
+                          if mapper.local_table is foreign_key.column.table)
+            column = getattr(target, foreign_key.column.key)
+            found = set(db.session.scalars(select(column).where(column.in_(values))))
+            for index, item in items.items():
+                if item.get(name) is not None and item[name] not in found:
+                    errors.setdefault(index, {})[name] = [f'{item[name]} does not exist.']
+        return errors
+
+    @classmethod
+    def after_bulk_create(cls, items):
+        """Hook run in the bulk_create transaction, the executemany bypasses the mapper events"""
 
 
 class BlogPost(BaseMixin, Base):
     __tablename__ = 'blog_posts'
+    __table_args__ = (
+        Index('ix_blog_posts_created_at_id', 'created_at', 'id'),
+        Index('ix_blog_posts_author_id', 'author_id'),
+        # only the few posts waiting for purge_deleted_posts are indexed
+        Index('ix_blog_posts_deleted_at', 'deleted_at', postgresql_where=text('deleted_at IS NOT NULL'),
+              sqlite_where=text('deleted_at IS NOT NULL')),
+    )
     id = Column(Integer, primary_key=True)
     title = Column(String(250), nullable=False)
     content = Column(Text, nullable=False)
     author_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    # comments = relationship('Comment', backref='blog_posts', lazy=True)
+    comment_count = Column(Integer, nullable=False, default=0, server_default='0')
+    last_comment_at = Column(DateTime, nullable=True)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    deleted_at = Column(DateTime, nullable=True)
+    comments = relationship('Comment', back_populates='post', lazy=True, passive_deletes='all')
+    author = relationship('User', back_populates='blog_posts', lazy=True)
+
+    # a stale update or delete of a loaded post fails instead of overwriting a newer version
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, title=None, content=None, author_id=None):
         self.title = title
@@ -56,6 +197,49 @@ class BlogPost(BaseMixin, Base):
     def __repr__(self):
         return f'<Post {self.title!r}>'
 
+    @classmethod
+    def delete_where(cls, *criteria):
+        """
+        Delete the posts matching criteria, the database deletes their comments (ON DELETE CASCADE).
+        Posts with more than POST_DELETE_CASCADE_LIMIT comments are only marked deleted, so one
+        transaction never holds the locks of a huge cascade: they disappear from every read and
+        `flask cleanup-comments` removes their comments in batches, then the posts.
+        """
+        limit = current_app.config.get('POST_DELETE_CASCADE_LIMIT', 1000)
+        with unit_of_work():
+            cascaded = cls._comments_of(select(cls.id).where(*criteria, cls.comment_count <= limit))
+            ids = super(BlogPost, cls).delete_where(*criteria, cls.comment_count <= limit)
+            ids += cls.update_where(*criteria, cls.comment_count > limit, deleted_at=datetime.datetime.utcnow())
+        after_commit(lambda: Comment.invalidate_rows(cascaded))
+        return ids
+
+    def delete(self):
+        cascaded = self._comments_of([self.id])
+        super(BlogPost, self).delete()
+        after_commit(lambda: Comment.invalidate_rows(cascaded))
+
+    @classmethod
+    def _comments_of(cls, post_ids):
+        """Ids of the comments the database deletes with the posts, their cached responses go too"""
+        return db.session.scalars(select(Comment.id).where(Comment.post_id.in_(post_ids))).all()
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _hide_deleted_posts(orm_execute_state):
+    """
+    Leave the posts marked deleted, and their comments, out of every ORM statement, unless it is run with
+    include_deleted. The comments are matched through the table, the loader criteria would hide the posts
+    marked deleted from the subquery too.
+    """
+    if (orm_execute_state.is_column_load or orm_execute_state.is_relationship_load
+            or orm_execute_state.execution_options.get('include_deleted', False)):
+        return
+    posts = BlogPost.__table__
+    deleted = select(posts.c.id).where(posts.c.deleted_at.is_not(None))
+    orm_execute_state.statement = orm_execute_state.statement.options(
+        with_loader_criteria(BlogPost, BlogPost.deleted_at.is_(None), include_aliases=True),
+        with_loader_criteria(Comment, Comment.post_id.not_in(deleted), include_aliases=True))
+
 
 class BlogPostSchema(Schema):
     """Blogpost Schema"""
@@ -63,15 +247,31 @@ class BlogPostSchema(Schema):
     title = fields.Str(required=True)
     content = fields.Str(required=True)
     author_id = fields.Int(required=True)
+    comment_count = fields.Int(dump_only=True)
+    last_comment_at = fields.DateTime(dump_only=True)
+    version = fields.Int(dump_only=True)
     created_at = fields.DateTime(dump_only=True)
+    updated_at = fields.DateTime(dump_only=True)
+    comments = fields.Nested('CommentSchema', many=True, exclude=('author', 'post'), dump_only=True)
+    author = fields.Nested('UserSchema', only=('id', 'username', 'created_at'), dump_only=True)
 
 
 class Comment(BaseMixin, Base):
     __tablename__ = 'comments'
+    __table_args__ = (
+        Index('ix_comments_post_id_created_at_id', 'post_id', 'created_at', 'id'),
+        Index('ix_comments_created_at_id', 'created_at', 'id'),
+        Index('ix_comments_author_id', 'author_id'),
+    )
     id = Column(Integer, primary_key=True)
     content = Column(Text, nullable=False)
     author_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    post_id = Column(Integer, ForeignKey('blog_posts.id'), nullable=False)
+    post_id = Column(Integer, ForeignKey('blog_posts.id', ondelete='CASCADE'), nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    post = relationship('BlogPost', back_populates='comments', lazy=True)
+    author = relationship('User', back_populates='comments', lazy=True)
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, content=None, post_id=None, author_id=None):
         self.content = content
@@ -82,6 +282,102 @@ class Comment(BaseMixin, Base):
     def __repr__(self):
         return f'<Comment {self.id!r}>'
 
+    def invalidate(self):
+        super(Comment, self).invalidate()
+        response_cache.invalidate(BlogPost.__tablename__, self.post_id)
+
+    def update(self, data):
+        old_post_id = self.post_id
+        super(Comment, self).update(data)
+        after_commit(lambda: response_cache.invalidate(BlogPost.__tablename__, old_post_id))
+
+    def delete(self):
+        post_id = self.post_id
+        super(Comment, self).delete()
+        after_commit(lambda: response_cache.invalidate(BlogPost.__tablename__, post_id))
+
+    @classmethod
+    def bulk_create(cls, items):
+        ids = super(Comment, cls).bulk_create(items)
+        post_ids = {item['post_id'] for item in items}
+        after_commit(lambda: BlogPost.invalidate_rows(post_ids))
+        return ids
+
+    @classmethod
+    def update_returning(cls, *criteria, **values):
+        if 'post_id' not in values:
+            return super(Comment, cls).update_returning(*criteria, **values)
+        # the statement skips the mapper events, so the counters of both posts are moved here
+        with unit_of_work():
+            left = cls._posts_where(*criteria)
+            rows = super(Comment, cls).update_returning(*criteria, **values)
+            cls._move_counters(left, -1)
+            cls._move_counters(Counter({values['post_id']: len(rows)}), 1)
+        return rows
+
+    @classmethod
+    def delete_where(cls, *criteria):
+        with unit_of_work():
+            left = cls._posts_where(*criteria)
+            ids = super(Comment, cls).delete_where(*criteria)
+            cls._move_counters(left, -1)
+        return ids
+
+    @classmethod
+    def _posts_where(cls, *criteria):
+        """Comments per post of the rows matching criteria, locked until the end of the transaction"""
+        return Counter(db.session.scalars(select(cls.post_id).where(*criteria).with_for_update()))
+
+    @classmethod
+    def _move_counters(cls, per_post, sign):
+        for post_id, count in per_post.items():
+            if count:
+                db.session.execute(comment_counter_update(post_id, sign * count))
+        after_commit(lambda: BlogPost.invalidate_rows(per_post))
+
+    @classmethod
+    def after_bulk_create(cls, items):
+        per_post = Counter(item['post_id'] for item in items)
+        for post_id, count in per_post.items():
+            db.session.execute(comment_counter_update(post_id, count))
+
+
+def comment_counter_update(post_id, delta):
+    """
+    UPDATE moving the comment counter of a post by delta in the database, so concurrent
+    writers do not overwrite each other, and refreshing last_comment_at from the comments
+    """
+    last_comment_at = select(func.max(Comment.created_at)).where(Comment.post_id == post_id).scalar_subquery()
+    return (
+        update(BlogPost)
+        .where(BlogPost.id == post_id)
+        .values(
+            comment_count=BlogPost.comment_count + delta,
+            last_comment_at=last_comment_at,
+            updated_at=datetime.datetime.utcnow(),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+@event.listens_for(Comment, 'after_insert')
+def _comment_inserted(mapper, connection, target):
+    connection.execute(comment_counter_update(target.post_id, 1))
+
+
+@event.listens_for(Comment, 'after_delete')
+def _comment_deleted(mapper, connection, target):
+    connection.execute(comment_counter_update(target.post_id, -1))
+
+
+@event.listens_for(Comment, 'after_update')
+def _comment_moved(mapper, connection, target):
+    history = get_history(target, 'post_id')
+    if history.deleted and history.added:
+        for post_id in history.deleted:
+            connection.execute(comment_counter_update(post_id, -1))
+        connection.execute(comment_counter_update(target.post_id, 1))
+
 
 class CommentSchema(Schema):
     """Comment Schema"""
@@ -89,17 +385,24 @@ class CommentSchema(Schema):
     content = fields.Str(required=True)
     author_id = fields.Int(required=True)
     post_id = fields.Int(required=True)
+    version = fields.Int(dump_only=True)
     created_at = fields.DateTime(dump_only=True)
+    updated_at = fields.DateTime(dump_only=True)
+    post = fields.Nested('BlogPostSchema', exclude=('comments', 'author'), dump_only=True)
+    author = fields.Nested('UserSchema', only=('id', 'username', 'created_at'), dump_only=True)
 
 
 class User(BaseMixin, Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('ix_users_created_at_id', 'created_at', 'id'),
+    )
     id = Column(Integer, primary_key=True)
     username = Column(String(50), unique=True)
     email = Column(String(120), unique=True)
     password_hash = Column(String(128), nullable=True)
-    # blog_posts = relationship('BlogpostModel', backref='users', lazy=True)
-    # comments = relationship('Comment', backref='users', lazy=True)
+    blog_posts = relationship('BlogPost', back_populates='author', lazy=True, passive_deletes='all')
+    comments = relationship('Comment', back_populates='author', lazy=True, passive_deletes='all')
 
     def __init__(self, username=None, email=None, password=None):
         self.username = username
@@ -110,11 +413,47 @@ class User(BaseMixin, Base):
     def __repr__(self):
         return f'<User {self.username!r}>'
 
+    def update(self, data):
+        super(User, self).update(data)
+        after_commit(lambda: identity_cache.invalidate(self.id))
+
+    def delete(self):
+        user_id = self.id
+        tokens.revoke_user(user_id)
+        super(User, self).delete()
+        after_commit(lambda: identity_cache.invalidate(user_id))
+
+    @classmethod
+    def delete_where(cls, *criteria):
+        ids = super(User, cls).delete_where(*criteria)
+        for user_id in ids:
+            tokens.revoke_user(user_id)
+            after_commit(lambda user_id=user_id: identity_cache.invalidate(user_id))
+        return ids
+
     def generate_hash(self, password):
-        return bcrypt.generate_password_hash(password, rounds=10)
+        return hasher.generate_hash(password)
 
     def check_hash(self, password):
-        return bcrypt.check_password_hash(self.password_hash, password)
+        return hasher.check_hash(self.password_hash, password)
+
+    def upgrade_hash(self, password):
+        """Re-hash the password if the configured rounds changed, without holding up the login"""
+        if not hasher.needs_rehash(self.password_hash):
+            return
+        app = current_app._get_current_object()
+        user_id, old_hash = self.id, self.password_hash
+
+        def save(new_hash):
+            with app.app_context():
+                db.session.execute(
+                    db.update(User)
+                    .where(User.id == user_id, User.password_hash == old_hash)
+                    .values(password_hash=new_hash)
+                )
+                db.session.commit()
+
+        hasher.rehash_later(password, save)
 
 
 class UserSchema(Schema):
@@ -124,4 +463,5 @@ class UserSchema(Schema):
     email = fields.Email(required=True)
     password = fields.Str(required=True, load_only=True)
     created_at = fields.DateTime(dump_only=True)
+    updated_at = fields.DateTime(dump_only=True)
     # blog_posts = fields.Nested(BlogPostSchema, many=True)
@@ -0,0 +1,44 @@
+from flask import Blueprint, Response, jsonify, current_app
+from sqlalchemy.exc import SQLAlchemyError
+
+from .cache import response_cache
+from .models import db
+from .pool import pool_stats
+from .profiling import profiler
+from .utils import error_response
+
+ops_api = Blueprint('ops_api', __name__)
+
+
+@ops_api.route('/health', methods=['GET'])
+def health():
+    """Liveness: the process is serving requests"""
+    return jsonify({'status': 'ok'}), 200
+
+
+@ops_api.route('/ready', methods=['GET'])
+def ready():
+    """Readiness: the database is reachable"""
+    try:
+        db.session.execute(db.text('SELECT 1'))
+    except SQLAlchemyError:
+        db.session.rollback()
+        return error_response('Database is not available', code=503)
+    return jsonify({'status': 'ready'}), 200
+
+
+@ops_api.route('/stats', methods=['GET'])
+def stats():
+    """Runtime counters of this app process"""
+    return jsonify({
+        'response_cache': response_cache.stats(),
+        'db_pool': pool_stats(db.engine),
+    }), 200
+
+
+@ops_api.route('/metrics', methods=['GET'])
+def metrics():
+    """Per endpoint latency histograms and SQL, dump and bcrypt totals in the Prometheus format"""
+    if not current_app.config['PROFILING_ENABLED']:
+        return error_response('Profiling is not enabled', code=404)
+    return Response(profiler.metrics(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,70 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+
+import markdown
+import markdown.extensions.fenced_code
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+
+class MarkdownPage(object):
+    """
+    Markdown file rendered to HTML once and kept in memory with precompressed bodies.
+    The file is re-rendered when its mtime changes, checked at most every check_interval seconds.
+    """
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.bodies = {}
+        self.etag = None
+        self._mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def _render(self):
+        with open(self.path, 'r') as md_file:
+            html = markdown.markdown(md_file.read(), extensions=["fenced_code"]).encode('utf-8')
+        bodies = {
+            'identity': html,
+            'gzip': gzip.compress(html, compresslevel=9),
+        }
+        if brotli is not None:
+            bodies['br'] = brotli.compress(html)
+        return bodies, hashlib.sha1(html).hexdigest()
+
+    def refresh(self):
+        now = time.monotonic()
+        if self._mtime is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self._mtime:
+                self.bodies, self.etag = self._render()
+                self._mtime = mtime
+
+    def response(self):
+        self.refresh()
+        bodies, etag = self.bodies, self.etag
+        encoding = request.accept_encodings.best_match([e for e in ('br', 'gzip') if e in bodies], 'identity')
+        etag = f'{etag}-{encoding}'
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(bodies[encoding], mimetype='text/html')
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = 60
+        return response
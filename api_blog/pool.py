@@ -0,0 +1,99 @@
+import time
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+# Upper bounds in seconds of the checkout wait histogram
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+# Postgres errors worth a retry: connection failures (class 08), query canceled by statement_timeout,
+# server shutting down and too many connections
+TRANSIENT_PGCODES = ('08', '57014', '57P01', '57P02', '57P03', '53300')
+# SQLite errors worth a retry: another connection holds the lock
+TRANSIENT_SQLITE_MESSAGES = ('database is locked', 'database table is locked')
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool recording how long checkouts wait for a connection and how often they time out"""
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * len(WAIT_BUCKETS)
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        except PoolTimeout:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            self._record_wait(time.perf_counter() - started)
+
+    def _record_wait(self, wait):
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            for index, bound in enumerate(WAIT_BUCKETS):
+                if wait <= bound:
+                    self.wait_buckets[index] += 1
+                    break
+
+    def stats(self):
+        capacity = self.size() + self._max_overflow if self._max_overflow >= 0 else None
+        with self._stats_lock:
+            return {
+                'size': self.size(),
+                'max_overflow': self._max_overflow,
+                'checked_out': self.checkedout(),
+                'saturation': self.checkedout() / capacity if capacity else None,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_avg_ms': self.wait_total / self.checkouts * 1000 if self.checkouts else 0,
+                'wait_max_ms': self.wait_max * 1000,
+                'wait_buckets': {str(bound): count for bound, count in zip(WAIT_BUCKETS, self.wait_buckets)},
+            }
+
+
+def configure_pool(app):
+    """Use the instrumented pool unless the config picks another pool class"""
+    options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    options.setdefault('poolclass', InstrumentedQueuePool)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats()
+    return {'status': pool.status()}
+
+
+def is_transient(error):
+    """True for an OperationalError that a retry may not hit again: a lost connection, a timeout or a lock"""
+    if error.connection_invalidated:
+        return True
+    pgcode = getattr(error.orig, 'pgcode', None)
+    if pgcode:
+        return pgcode.startswith(TRANSIENT_PGCODES)
+    return str(error.orig).startswith(TRANSIENT_SQLITE_MESSAGES)
+
+
+def _sqlite_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+def enforce_foreign_keys(engine):
+    """SQLite only checks foreign keys, and runs their ON DELETE actions, when every connection asks for it"""
+    if engine.dialect.name == 'sqlite' and not event.contains(engine, 'connect', _sqlite_foreign_keys):
+        event.listen(engine, 'connect', _sqlite_foreign_keys)
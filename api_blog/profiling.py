@@ -0,0 +1,166 @@
+import re
+import time
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import current_app, request, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# (metric, part of the request profile, durations or counts, help)
+COUNTERS = (
+    ('api_blog_sql_statements_total', 'sql', 'counts', 'SQL statements run by requests.'),
+    ('api_blog_sql_seconds_total', 'sql', 'durations', 'Time spent in SQL statements.'),
+    ('api_blog_dump_seconds_total', 'dump', 'durations', 'Time spent serializing responses.'),
+    ('api_blog_bcrypt_total', 'bcrypt', 'counts', 'Password hashes computed or checked.'),
+    ('api_blog_bcrypt_seconds_total', 'bcrypt', 'durations', 'Time spent hashing passwords.'),
+)
+
+# Literals stripped from statements to group the queries of an N+1 pattern
+LITERALS = re.compile(r"'[^']*'|\b\d+\b")
+
+
+class RequestProfile(object):
+    """Time spent by one request, split into sql, dump and bcrypt"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = Counter()
+        self.counts = Counter()
+        self.statements = Counter()
+
+    def add(self, name, seconds):
+        self.durations[name] += seconds
+        self.counts[name] += 1
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent in the block to the profile of the current request, if it is profiled"""
+    profile = g.get('profile') if has_request_context() else None
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - started)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = g.get('profile') if has_request_context() else None
+    if profile is not None:
+        profile.add('sql', time.perf_counter() - conn.info['query_started'])
+        profile.statements[LITERALS.sub('?', statement)] += 1
+
+
+class Profiler(object):
+    """
+    Opt-in per endpoint timings: wall time, SQL statements and time, dump time and bcrypt time.
+    Reported in the Server-Timing header of every response and as Prometheus metrics.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.sql = {}
+        self.totals = Counter()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILING_ENABLED', False)
+        app.config.setdefault('PROFILING_QUERY_THRESHOLD', 20)
+        if not app.config['PROFILING_ENABLED']:
+            return
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    def start(self):
+        g.profile = RequestProfile()
+
+    def finish(self, response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        wall = time.perf_counter() - profile.started
+        endpoint = request.endpoint or 'unknown'
+        self.observe(endpoint, request.method, wall, profile)
+
+        timings = [f'app;dur={wall * 1000:.2f}']
+        timings += [
+            f'{name};desc="{profile.counts[name]}";dur={profile.durations[name] * 1000:.2f}'
+            for name in ('sql', 'dump', 'bcrypt') if profile.counts[name]
+        ]
+        response.headers['Server-Timing'] = ', '.join(timings)
+
+        queries = profile.counts['sql']
+        if queries > current_app.config['PROFILING_QUERY_THRESHOLD']:
+            statement, repeats = profile.statements.most_common(1)[0]
+            logger.warning('%s %s ran %d queries, %d times: %s',
+                           request.method, request.path, queries, repeats, statement[:200])
+        return response
+
+    def observe(self, endpoint, method, wall, profile):
+        key = (endpoint, method)
+        with self._lock:
+            self.requests.setdefault(key, Histogram()).observe(wall)
+            self.sql.setdefault(key, Histogram()).observe(profile.durations['sql'])
+            for name, part, kind, _ in COUNTERS:
+                self.totals[(name,) + key] += getattr(profile, kind)[part]
+
+    def metrics(self):
+        """The collected metrics in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            for name, help_text, histograms in (
+                    ('api_blog_request_duration_seconds', 'Request wall time.', self.requests),
+                    ('api_blog_request_sql_duration_seconds', 'SQL time per request.', self.sql)):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for (endpoint, method), histogram in sorted(histograms.items()):
+                    labels = f'endpoint="{endpoint}",method="{method}"'
+                    for bound, count in zip(LATENCY_BUCKETS, histogram.buckets):
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+            for name, _, _, help_text in COUNTERS:
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                for (total, endpoint, method), value in sorted(self.totals.items()):
+                    if total == name:
+                        lines.append(f'{name}{{endpoint="{endpoint}",method="{method}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+profiler = Profiler()
@@ -0,0 +1,185 @@
+import math
+import logging
+import re
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+
+from .utils import decode_token
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - redis is optional
+    redis = None
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+LIMIT = re.compile(r'^\s*(\d+)\s*/\s*(second|minute|hour|day)\s*$')
+
+# Refill and take one token atomically, with the Redis clock shared by every worker
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(retry_after)
+"""
+
+
+def parse_limit(limit):
+    """'10/minute' -> (tokens refilled per second, bucket capacity)"""
+    match = LIMIT.match(limit)
+    if not match:
+        raise ValueError(f'Invalid rate limit {limit!r}, expected "<count>/<second|minute|hour|day>"')
+    count, period = int(match.group(1)), PERIODS[match.group(2)]
+    return count / period, count
+
+
+class MemoryBuckets(object):
+    """Token buckets of this process, the least recently used are dropped past max_size"""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, capacity):
+        """Take a token from the bucket of key, return 0 or the seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            retry_after = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class RedisBuckets(object):
+    """Token buckets shared between workers, updated by a Lua script"""
+
+    def __init__(self, client, prefix='api_blog:rate_limit:'):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        if redis is None:
+            raise RuntimeError('The redis package is required for a Redis rate limit backend')
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def take(self, key, rate, capacity):
+        return float(self._take(keys=[self.prefix + key], args=[rate, capacity]))
+
+
+class TooManyRequests(Exception):
+    """Raised when the client used up its rate limit"""
+
+    def __init__(self, retry_after):
+        super(TooManyRequests, self).__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class EndpointBusy(Exception):
+    """Raised when all the concurrency slots of an endpoint class are taken"""
+
+
+class RateLimiter(object):
+    """
+    Admission control for groups of endpoints: a token bucket per client and route,
+    and a bound on the requests of the group in progress in this process.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATE_LIMIT_ENABLED', True)
+        app.config.setdefault('RATE_LIMITS', {'auth': '10/minute', 'write': '60/minute', 'export': '10/minute'})
+        app.config.setdefault('CONCURRENCY_LIMITS', {})
+        app.config.setdefault('RATE_LIMIT_SIZE', 100000)
+        buckets = app.config.get('RATE_LIMIT_BACKEND')
+        if buckets is None and app.config.get('RATE_LIMIT_REDIS_URL'):
+            buckets = RedisBuckets.from_url(app.config['RATE_LIMIT_REDIS_URL'])
+        if buckets is None:
+            buckets = MemoryBuckets(max_size=app.config['RATE_LIMIT_SIZE'])
+        threads = app.config.get('WEB_THREADS')
+        for name, size in app.config['CONCURRENCY_LIMITS'].items():
+            if threads and threads > 1 and size and size >= threads:
+                logger.warning('CONCURRENCY_LIMITS[%r] is %d, with %d threads per worker the other endpoints '
+                               'can be starved, keep it below the thread count', name, size, threads)
+        app.extensions['rate_limit'] = {
+            'buckets': buckets,
+            'limits': {name: parse_limit(limit) for name, limit in app.config['RATE_LIMITS'].items()},
+            'slots': {name: threading.BoundedSemaphore(size)
+                      for name, size in app.config['CONCURRENCY_LIMITS'].items() if size},
+        }
+
+    def client_key(self):
+        """The user of a valid api-token, else the client address. Checked without the database."""
+        token = request.headers.get('api-token')
+        if token:
+            user_id = decode_token(token).get('user_id')
+            if user_id is not None:
+                return f'user:{user_id}'
+        return f'ip:{request.remote_addr}'
+
+    def check(self, group):
+        state = current_app.extensions['rate_limit']
+        limit = state['limits'].get(group)
+        if limit is None or not current_app.config['RATE_LIMIT_ENABLED']:
+            return
+        rate, capacity = limit
+        key = f'{group}:{request.endpoint}:{request.method}:{self.client_key()}'
+        retry_after = state['buckets'].take(key, rate, capacity)
+        if retry_after:
+            raise TooManyRequests(retry_after)
+
+    def limit(self, group):
+        """Rate limit and bound the concurrency of a view with the limits of group"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                self.check(group)
+                slots = current_app.extensions['rate_limit']['slots'].get(group)
+                if slots is None:
+                    return func(*args, **kwargs)
+                if not slots.acquire(blocking=False):
+                    raise EndpointBusy()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    slots.release()
+            return wrapper
+        return decorator
+
+
+def retry_after_header(seconds):
+    return str(max(1, math.ceil(seconds)))
+
+
+limiter = RateLimiter()
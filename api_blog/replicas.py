@@ -0,0 +1,103 @@
+import itertools
+import threading
+import time
+
+from flask import current_app, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import SQLAlchemyError
+
+# Cookie set on responses to writes, reads carrying it stay on the primary
+PRIMARY_COOKIE = 'read_primary'
+
+
+class ReplicaSet(object):
+    """Read replica engines with their replication lag checked every check_interval seconds"""
+
+    def __init__(self, engines, max_lag=5, check_interval=5):
+        self.engines = engines
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.healthy = list(engines)
+        self._checked_at = time.monotonic()
+        self._cycle = itertools.cycle(range(len(engines))) if engines else None
+        self._lock = threading.Lock()
+
+    def lag(self, engine):
+        """Seconds the replica is behind the primary, 0 when the database can not tell"""
+        if engine.dialect.name != 'postgresql':
+            return 0
+        with engine.connect() as conn:
+            lag = conn.execute(text(
+                'SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())'
+            )).scalar()
+        return float(lag or 0)
+
+    def check(self):
+        healthy = []
+        for engine in self.engines:
+            try:
+                if self.lag(engine) <= self.max_lag:
+                    healthy.append(engine)
+            except SQLAlchemyError:
+                pass
+        self.healthy = healthy
+
+    def pick(self):
+        """A healthy replica, round robin, or None to read from the primary"""
+        if not self.engines:
+            return None
+        if time.monotonic() - self._checked_at > self.check_interval and self._lock.acquire(blocking=False):
+            # one thread refreshes the lag while the others keep the previous state
+            try:
+                self._checked_at = time.monotonic()
+                self.check()
+            finally:
+                self._lock.release()
+        healthy = self.healthy
+        if not healthy:
+            return None
+        return healthy[next(self._cycle) % len(healthy)]
+
+
+class RoutingSession(Session):
+    """
+    Session sending the SELECTs of a request marked with use_replica to a read replica.
+    Flushes, writes and everything after the first write of the session go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and self.info.get('use_replica')
+                and not self.info.get('wrote') and (clause is None or getattr(clause, 'is_select', False))
+                and has_app_context()):
+            replicas = current_app.extensions.get('replicas')
+            engine = replicas.pick() if replicas else None
+            if engine is not None:
+                # what was read may be behind the primary, the response cache must not keep it
+                self.info['read_replica'] = True
+                return engine
+        return super(RoutingSession, self).get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_flush(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _mark_statement(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['wrote'] = True
+
+
+def init_replicas(app):
+    app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+    app.config.setdefault('REPLICA_MAX_LAG', 5)
+    app.config.setdefault('REPLICA_CHECK_INTERVAL', 5)
+    options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    engines = [create_engine(uri, **options) for uri in app.config['SQLALCHEMY_REPLICA_URIS']]
+    app.extensions['replicas'] = ReplicaSet(
+        engines,
+        max_lag=app.config['REPLICA_MAX_LAG'],
+        check_interval=app.config['REPLICA_CHECK_INTERVAL'],
+    )
@@ -0,0 +1,94 @@
+import re
+
+from flask import Blueprint, request
+from sqlalchemy import DDL, event, func, literal_column, false
+
+from .models import db, BlogPost, BlogPostSchema
+from .utils import pagination, expand_options, json_response, error_response, read_replica
+from .cache import response_cache
+from .ratelimit import limiter
+
+search_api = Blueprint('search_api', __name__)
+
+# Postgres keeps a weighted tsvector of every post in a generated column, so it is
+# recomputed by the database on every insert and update of the row
+POSTGRES_DDL = [
+    "ALTER TABLE blog_posts ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(content, '')), 'B')) STORED",
+    "CREATE INDEX ix_blog_posts_search ON blog_posts USING GIN (search_vector)",
+]
+
+# SQLite indexes the posts in an external content FTS5 table kept in sync by triggers
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE blog_posts_fts USING fts5("
+    "title, content, content='blog_posts', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER blog_posts_fts_insert AFTER INSERT ON blog_posts BEGIN "
+    "INSERT INTO blog_posts_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+    "CREATE TRIGGER blog_posts_fts_delete AFTER DELETE ON blog_posts BEGIN "
+    "INSERT INTO blog_posts_fts(blog_posts_fts, rowid, title, content) "
+    "VALUES ('delete', old.id, old.title, old.content); END",
+    "CREATE TRIGGER blog_posts_fts_update AFTER UPDATE OF title, content ON blog_posts BEGIN "
+    "INSERT INTO blog_posts_fts(blog_posts_fts, rowid, title, content) "
+    "VALUES ('delete', old.id, old.title, old.content); "
+    "INSERT INTO blog_posts_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+]
+
+for statement in POSTGRES_DDL:
+    event.listen(BlogPost.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+for statement in SQLITE_DDL:
+    event.listen(BlogPost.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(BlogPost.__table__, 'before_drop',
+             DDL('DROP TABLE IF EXISTS blog_posts_fts').execute_if(dialect='sqlite'))
+
+# title matches count ten times as much as content matches
+TITLE_WEIGHT = 10.0
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Keep the search objects, which are created outside the models, out of autogenerate"""
+    if type_ == 'table' and name.startswith('blog_posts_fts'):
+        return False
+    if type_ == 'column' and name == 'search_vector':
+        return False
+    if type_ == 'index' and name == 'ix_blog_posts_search':
+        return False
+    return True
+
+
+def search_select(query):
+    """Select the posts matching query with the ORDER BY ranking the best matches first"""
+    db_select = db.select(BlogPost)
+    if db.engine.dialect.name == 'postgresql':
+        tsquery = func.websearch_to_tsquery('english', query)
+        vector = literal_column('blog_posts.search_vector')
+        rank = func.ts_rank_cd(vector, tsquery)
+        return db_select.where(vector.op('@@')(tsquery)), (rank.desc(), BlogPost.id.desc())
+
+    # FTS5 treats punctuation as syntax, so every word is quoted and all of them must match
+    words = WORD.findall(query)
+    if not words:
+        return db_select.where(false()), (BlogPost.id.desc(),)
+    match = ' '.join('"%s"' % word for word in words)
+    fts = literal_column('blog_posts_fts')
+    rank = func.bm25(fts, TITLE_WEIGHT, 1.0)
+    db_select = db_select.join_from(
+        BlogPost, db.table('blog_posts_fts'), literal_column('blog_posts_fts.rowid') == BlogPost.id)
+    return db_select.where(fts.op('MATCH')(match)), (rank, BlogPost.id.desc())
+
+
+@search_api.route('/search', methods=['GET'])
+@response_cache.cached(BlogPost)
+@limiter.limit('read')
+@read_replica
+def search_posts():
+    """Blog posts matching q, best matches first"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return error_response("Search query is required.")
+
+    options, schema = expand_options(request, BlogPost, BlogPostSchema, many=True)
+    db_select, order_by = search_select(query)
+    response = pagination(request, db_select.options(*options), schema, order_by=order_by)
+    return json_response(response)
@@ -0,0 +1,198 @@
+import gzip
+import sqlite3
+import json
+import unittest
+from sqlalchemy.exc import OperationalError
+from ..app import create_app
+from ..config import app_config, Test
+from ..models import db, BlogPost
+
+
+class AppTest(unittest.TestCase):
+    """App level endpoints Test Case"""
+
+    def setUp(self):
+        self.app = create_app("test")
+        self.client = self.app.test_client
+
+    def test_index(self):
+        """Test: the README is served as html"""
+        response = self.client().get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'<h1>API for Blog with comments</h1>', response.data)
+        self.assertTrue(response.headers.get('ETag'))
+
+    def test_index_not_modified(self):
+        """Test: the README is not resent when the client copy is fresh"""
+        response = self.client().get('/')
+        etag = response.headers.get('ETag')
+        response = self.client().get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_index_gzip(self):
+        """Test: the README is sent compressed when the client accepts it"""
+        plain = self.client().get('/').data
+        response = self.client().get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.decompress(response.data), plain)
+
+    def test_ready(self):
+        """Test: readiness checks the database"""
+        response = self.client().get('/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data).get('status'), 'ready')
+
+    def test_health(self):
+        """Test: liveness"""
+        response = self.client().get('/health')
+        self.assertEqual(response.status_code, 200)
+
+    def test_stats_db_pool(self):
+        """Test: connection pool counters are exposed"""
+        self.client().get('/posts/')
+        response = self.client().get('/stats')
+        data = json.loads(response.data).get('db_pool')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(data.get('checkouts'), 1)
+        self.assertEqual(data.get('timeouts'), 0)
+
+    def test_pool_exhausted(self):
+        """Test: requests fail fast with 503 when no connection is free"""
+        class SmallPool(Test):
+            SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 1, 'max_overflow': 0, 'pool_timeout': 0.05}
+        app_config['test_small_pool'] = SmallPool
+        self.addCleanup(app_config.pop, 'test_small_pool')
+        app = create_app('test_small_pool')
+
+        with app.app_context():
+            connection = db.engine.connect()
+            self.addCleanup(connection.close)
+            response = app.test_client().get('/posts/?page=3')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers.get('Retry-After'), '1')
+            self.assertEqual(db.engine.pool.stats().get('timeouts'), 1)
+            self.assertEqual(db.engine.pool.stats().get('saturation'), 1)
+
+    def test_database_errors(self):
+        """Test: timeouts, locks and lost connections get 503, other database errors are not retried"""
+        class QueryCanceled(Exception):
+            pgcode = '57014'
+        errors = {
+            'locked': sqlite3.OperationalError('database is locked'),
+            'canceled': QueryCanceled('canceling statement due to statement timeout'),
+            'missing': sqlite3.OperationalError('no such table: missing'),
+        }
+
+        @self.app.route('/error/<name>')
+        def error(name):
+            raise OperationalError('SELECT 1', {}, errors[name])
+
+        for name in ('locked', 'canceled'):
+            response = self.client().get(f'/error/{name}')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers.get('Retry-After'), '1')
+        with self.assertRaises(OperationalError):
+            self.client().get('/error/missing')
+
+    def test_profiling(self):
+        """Test: profiled requests report their timings and queries over the threshold are logged"""
+        class Profiled(Test):
+            PROFILING_ENABLED = True
+            PROFILING_QUERY_THRESHOLD = 1
+            RESPONSE_CACHE_ENABLED = False
+        app_config['test_profiled'] = Profiled
+        self.addCleanup(app_config.pop, 'test_profiled')
+        app = create_app('test_profiled')
+
+        with self.assertLogs('api_blog.profiling', level='WARNING') as logs:
+            response = app.test_client().get('/posts/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('sql;desc="2"', response.headers.get('Server-Timing'))
+        self.assertIn('dump;', response.headers.get('Server-Timing'))
+        self.assertIn('ran 2 queries', logs.output[0])
+
+        response = app.test_client().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'api_blog_request_duration_seconds_count{endpoint="posts-list",method="GET"}', response.data)
+        self.assertIn(b'api_blog_sql_statements_total{endpoint="posts-list",method="GET"}', response.data)
+
+    def test_proxy_fix(self):
+        """Test: behind a trusted proxy the rate limits are keyed by the forwarded client address"""
+        class Direct(Test):
+            RATE_LIMIT_ENABLED = True
+            RATE_LIMITS = {'auth': '1/minute'}
+
+        class BehindProxy(Direct):
+            PROXY_FIX_X_FOR = 1
+        app_config['test_direct'] = Direct
+        app_config['test_proxy'] = BehindProxy
+        self.addCleanup(app_config.pop, 'test_direct')
+        self.addCleanup(app_config.pop, 'test_proxy')
+
+        def login(app, address):
+            return app.test_client().post('/users/login', headers={'X-Forwarded-For': address},
+                                          json={'email': 'test@test.com', 'password': 'test_test'})
+        app = create_app('test_proxy')
+        self.assertNotEqual(login(app, '10.0.0.1').status_code, 429)
+        self.assertEqual(login(app, '10.0.0.1').status_code, 429)
+        self.assertNotEqual(login(app, '10.0.0.2').status_code, 429)
+
+        # without a trusted proxy the header is ignored
+        app = create_app('test_direct')
+        self.assertNotEqual(login(app, '10.0.0.1').status_code, 429)
+        self.assertEqual(login(app, '10.0.0.2').status_code, 429)
+
+    def test_metrics_disabled(self):
+        """Test: metrics are not exposed unless profiling is enabled"""
+        response = self.client().get('/metrics')
+        self.assertEqual(response.status_code, 404)
+
+    def test_read_replica(self):
+        """Test: anonymous reads go to the replica, clients that just wrote read from the primary"""
+        class WithReplica(Test):
+            SQLALCHEMY_REPLICA_URIS = ['sqlite:////tmp/test_replica.db']
+        app_config['test_replica'] = WithReplica
+        self.addCleanup(app_config.pop, 'test_replica')
+        app = create_app('test_replica')
+        replica = app.extensions['replicas'].engines[0]
+        db.metadata.create_all(replica)
+        self.addCleanup(db.metadata.drop_all, replica)
+        with replica.begin() as conn:
+            conn.execute(BlogPost.__table__.insert(), {'title': 'On the replica', 'content': 'x', 'author_id': 1})
+
+        client = app.test_client()
+        data = json.loads(client.get('/posts/').data)
+        self.assertEqual([post['title'] for post in data['data']], ['On the replica'])
+
+        user = {'username': 'test', 'email': 'test@test.com', 'password': 'test_test'}
+        response = client.post('/users/', headers={'Content-Type': 'application/json'}, data=json.dumps(user))
+        self.assertIn('read_primary=1', response.headers.get('Set-Cookie'))
+        data = json.loads(client.get('/posts/').data)
+        self.assertEqual(data['data'], [])
+
+        # the response cache neither keeps what a lagging replica returned nor answers the writer
+        headers = {'Content-Type': 'application/json', 'api-token': json.loads(response.data).get('jwt_token')}
+        response = client.post('/posts/', headers=headers, data=json.dumps({'title': 'Written', 'content': 'x'}))
+        self.assertEqual(response.status_code, 201)
+        for _ in range(2):
+            response = app.test_client().get('/posts/1')
+            self.assertEqual(json.loads(response.data).get('title'), 'On the replica')
+            self.assertEqual(response.headers.get('X-Cache'), 'MISS')
+        response = client.get('/posts/1')
+        self.assertEqual(json.loads(response.data).get('title'), 'Written')
+        self.assertIsNone(response.headers.get('X-Cache'))
+
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import time
+import unittest
+from unittest import mock
+
+from ..app import create_app
+from ..cache import MemoryBackend, RedisBackend, response_cache
+from ..ratelimit import MemoryBuckets, RedisBuckets
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class MemoryBackendTest(unittest.TestCase):
+    """In-process cache backend Test Case"""
+
+    def test_lru_eviction(self):
+        """Test: the least recently used entry is evicted first"""
+        cache = MemoryBackend(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expiry(self):
+        """Test: entries are not returned after their ttl"""
+        cache = MemoryBackend()
+        cache.set('a', 1, ttl=0.01)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+
+    def test_delete(self):
+        """Test: deleted entries are gone"""
+        cache = MemoryBackend()
+        cache.set('a', 1)
+        cache.delete('a')
+        cache.delete('missing')
+        self.assertIsNone(cache.get('a'))
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisBackendTest(unittest.TestCase):
+    """Shared cache backend Test Case"""
+
+    def setUp(self):
+        self.cache = RedisBackend(fakeredis.FakeRedis())
+
+    def test_set_get(self):
+        """Test: values round trip through Redis"""
+        self.cache.set('a', {'id': 1}, ttl=10)
+        self.assertEqual(self.cache.get('a'), {'id': 1})
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_prefix(self):
+        """Test: backends with different prefixes do not share keys"""
+        other = RedisBackend(self.cache.client, prefix='other:')
+        self.cache.set('a', 1)
+        self.assertIsNone(other.get('a'))
+
+    def test_generations_expire(self):
+        """Test: the generation tokens of the response cache expire, no later than the entries they key"""
+        app = create_app('test')
+        app.config['RESPONSE_CACHE_GENERATION_TTL'] = 30
+        app.extensions['response_cache'] = self.cache
+        with app.test_request_context():
+            response_cache.invalidate('blog_posts', 1)
+            self.assertEqual(self.cache.client.ttl('api_blog:gen:blog_posts'), 60)
+            self.assertEqual(self.cache.client.ttl('api_blog:gen:blog_posts:1'), 60)
+
+    def test_invalidate_rows(self):
+        """Test: the generations of a table and of many of its rows are renewed in one round trip"""
+        app = create_app('test')
+        app.extensions['response_cache'] = self.cache
+        with app.test_request_context():
+            before = [self.cache.get(key) for key in ('gen:comments', 'gen:comments:1')]
+            with mock.patch.object(self.cache.client, 'set') as single_set:
+                with mock.patch.object(self.cache.client, 'pipeline', wraps=self.cache.client.pipeline) as pipeline:
+                    response_cache.invalidate_rows('comments', range(1000))
+            single_set.assert_not_called()
+            self.assertEqual(pipeline.call_count, 1)
+            after = [self.cache.get(key) for key in ('gen:comments', 'gen:comments:1', 'gen:comments:999')]
+            self.assertNotIn(None, after)
+            self.assertNotEqual(before, after[:2])
+
+
+class MemoryBucketsTest(unittest.TestCase):
+    """In-process rate limit buckets Test Case"""
+
+    def test_take(self):
+        """Test: the bucket allows a burst of its capacity, then refills at its rate"""
+        buckets = MemoryBuckets()
+        self.assertEqual([buckets.take('a', 100, 2) for _ in range(2)], [0, 0])
+        self.assertGreater(buckets.take('a', 100, 2), 0)
+        self.assertEqual(buckets.take('b', 100, 2), 0)
+        time.sleep(0.02)
+        self.assertEqual(buckets.take('a', 100, 2), 0)
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisBucketsTest(unittest.TestCase):
+    """Shared rate limit buckets Test Case"""
+
+    def test_take(self):
+        """Test: the Lua script empties and refills the bucket"""
+        client = fakeredis.FakeRedis()
+        try:
+            client.eval('return 1', 0)
+        except Exception:
+            self.skipTest('fakeredis can not run Lua scripts without lupa')
+        buckets = RedisBuckets(client)
+        self.assertEqual([buckets.take('a', 100, 2) for _ in range(2)], [0, 0])
+        self.assertGreater(buckets.take('a', 100, 2), 0)
+        time.sleep(0.02)
+        self.assertEqual(buckets.take('a', 100, 2), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
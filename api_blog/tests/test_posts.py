@@ -1,7 +1,8 @@
 import unittest
 import json
+from sqlalchemy import event
 from ..app import create_app
-from ..models import db
+from ..models import db, BlogPost, Comment, unit_of_work
 
 
 class PostsTest(unittest.TestCase):
@@ -92,6 +93,156 @@ class PostsTest(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data.get('title'), new_title)
 
+    def test_blog_patch_single_statement(self):
+        """Test: an update checks the author and version in one statement"""
+        api_token = self.test_blog_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        response = self.client().get('/posts/1', headers=self.headers)
+        self.assertEqual(json.loads(response.data).get('version'), 1)
+
+        statements = []
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        response = self.client().patch('/posts/1', headers=dict(headers, **{'If-Match': '"1"'}),
+                                       data=json.dumps({'title': 'Changed title'}))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data.get('title'), 'Changed title')
+        self.assertEqual(data.get('version'), 2)
+        self.assertTrue(response.headers['ETag'].startswith('"2-'))
+        # the identity is cached, the update returns the row
+        self.assertEqual([statement.split()[0] for statement in statements], ['UPDATE'])
+
+        response = self.client().patch('/posts/1', headers=dict(headers, **{'If-Match': '"1"'}),
+                                       data=json.dumps({'title': 'Lost update'}))
+        self.assertEqual(response.status_code, 412)
+        response = self.client().delete('/posts/1', headers=dict(headers, **{'If-Match': '"1"'}))
+        self.assertEqual(response.status_code, 412)
+        response = self.client().get('/posts/1', headers=self.headers)
+        self.assertEqual(json.loads(response.data).get('title'), 'Changed title')
+
+    def test_blog_patch_and_delete_not_allowed(self):
+        """Test: updates and deletes of a missing item or of another author"""
+        self.test_blog_create()
+        user_data = {'username': 'other', 'email': 'other@test.com', 'password': 'test_test'}
+        response = self.client().post('/users/', headers=self.headers, data=json.dumps(user_data))
+        headers = {'Content-Type': 'application/json', 'api-token': json.loads(response.data).get('jwt_token')}
+
+        response = self.client().patch('/posts/1', headers=headers, data=json.dumps({'title': 'Changed title'}))
+        self.assertEqual(response.status_code, 403)
+        response = self.client().delete('/posts/1', headers=headers)
+        self.assertEqual(response.status_code, 403)
+        response = self.client().patch('/posts/5', headers=headers, data=json.dumps({'title': 'Changed title'}))
+        self.assertEqual(response.status_code, 404)
+        response = self.client().delete('/posts/5', headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_blog_one_not_modified(self):
+        """Test: get one post again with its ETag"""
+        api_token = self.test_blog_create()
+        response = self.client().get('/posts/1', headers=self.headers)
+        etag = response.headers.get('ETag')
+        self.assertTrue(etag.startswith('"1-'))
+        self.assertTrue(response.headers.get('Last-Modified'))
+
+        response = self.client().get('/posts/1', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers.get('ETag'), etag)
+
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        response = self.client().patch('/posts/1', headers=headers, data=json.dumps({'title': 'Changed title'}))
+        self.assertEqual(response.status_code, 200)
+        response = self.client().get('/posts/1', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers.get('ETag'), etag)
+
+    def test_blog_one_etag_follows_comments(self):
+        """Test: a new comment changes the ETag of its post, though not the version"""
+        api_token = self.test_blog_create()
+        response = self.client().get('/posts/1', headers=self.headers)
+        etag = response.headers.get('ETag')
+
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        response = self.client().post('/comments/', headers=headers, data=json.dumps(self.comment_data))
+        self.assertEqual(response.status_code, 201)
+        response = self.client().get('/posts/1', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data).get('comment_count'), 1)
+        self.assertNotEqual(response.headers.get('ETag'), etag)
+        self.assertTrue(response.headers.get('ETag').startswith('"1-'))
+
+        # only the version is compared by If-Match
+        response = self.client().patch('/posts/1', headers=dict(headers, **{'If-Match': etag}),
+                                       data=json.dumps({'title': 'Changed title'}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_blog_etag_round_trip(self):
+        """Test: the ETag of a read is the If-Match of a write, and the ETag of a write is fresh for a read"""
+        api_token = self.test_blog_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        response = self.client().get('/posts/1?expand=comments', headers=self.headers)
+        expanded_etag = response.headers.get('ETag')
+        self.assertTrue(expanded_etag.startswith('"1-'))
+        response = self.client().get('/posts/1', headers=self.headers)
+        etag = response.headers.get('ETag')
+
+        response = self.client().patch('/posts/1', headers=dict(headers, **{'If-Match': etag}),
+                                       data=json.dumps({'title': 'Changed title'}))
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        response = self.client().get('/posts/1', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client().patch('/posts/1', headers=dict(headers, **{'If-Match': expanded_etag}),
+                                       data=json.dumps({'title': 'Lost update'}))
+        self.assertEqual(response.status_code, 412)
+        response = self.client().get('/posts/1?expand=comments', headers=self.headers)
+        response = self.client().delete('/posts/1', headers=dict(headers, **{'If-Match': response.headers['ETag']}))
+        self.assertEqual(response.status_code, 204)
+
+    def test_blog_list_not_modified(self):
+        """Test: get the list of posts again with its ETag"""
+        api_token = self.test_blog_create()
+        response = self.client().get('/posts/?expand=comments', headers=self.headers)
+        etag = response.headers.get('ETag')
+        self.assertIn('public', response.headers.get('Cache-Control'))
+
+        response = self.client().get('/posts/?expand=comments', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        response = self.client().post('/comments/', headers=headers, data=json.dumps(self.comment_data))
+        self.assertEqual(response.status_code, 201)
+        response = self.client().get('/posts/?expand=comments', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_blog_one_cached(self):
+        """Test: anonymous reads are served from the response cache until the post changes"""
+        api_token = self.test_blog_create()
+        response = self.client().get('/posts/1', headers=self.headers)
+        self.assertEqual(response.headers.get('X-Cache'), 'MISS')
+        etag = response.headers.get('ETag')
+        response = self.client().get('/posts/1', headers=self.headers)
+        self.assertEqual(response.headers.get('X-Cache'), 'HIT')
+        self.assertEqual(response.headers.get('ETag'), etag)
+        self.assertEqual(json.loads(response.data).get('title'), 'My first post')
+
+        response = self.client().get('/posts/1', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.headers.get('X-Cache'), 'HIT')
+        self.assertEqual(response.status_code, 304)
+
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        response = self.client().patch('/posts/1', headers=headers, data=json.dumps({'title': 'Changed title'}))
+        self.assertEqual(response.status_code, 200)
+        response = self.client().get('/posts/1', headers=self.headers)
+        self.assertEqual(response.headers.get('X-Cache'), 'MISS')
+        self.assertEqual(json.loads(response.data).get('title'), 'Changed title')
+
+        response = self.client().get('/stats')
+        data = json.loads(response.data)
+        self.assertGreaterEqual(data.get('response_cache').get('hits'), 2)
+
     def test_blog_list(self):
         """Test: get the list of posts"""
         self.test_blog_create()
@@ -121,6 +272,73 @@ class PostsTest(unittest.TestCase):
         self.assertEqual(len(data.get("data")), 1)
         self.assertTrue(data.get('next'))
 
+    def test_blog_list_cursor(self):
+        """Test: get the list of posts with cursor pagination"""
+        api_token = self.test_blog_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        for title in ('Second post', 'Third post'):
+            post_data = {'title': title, 'content': 'Content'}
+            response = self.client().post('/posts/', headers=headers, data=json.dumps(post_data))
+            self.assertEqual(response.status_code, 201)
+
+        response = self.client().get('/posts/?cursor=&per_page=2', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['title'] for item in data.get('data')], ['My first post', 'Second post'])
+        self.assertFalse(data.get('prev'))
+        self.assertIn('cursor=', data.get('next'))
+
+        response = self.client().get(data.get('next'), headers=self.headers)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['title'] for item in data.get('data')], ['Third post'])
+        self.assertFalse(data.get('next'))
+
+        response = self.client().get(data.get('prev'), headers=self.headers)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['title'] for item in data.get('data')], ['My first post', 'Second post'])
+        self.assertFalse(data.get('prev'))
+
+    def test_blog_search(self):
+        """Test: search posts, title matches first, index follows updates and deletes"""
+        api_token = self.test_blog_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        posts = [
+            {'title': 'Cooking', 'content': 'Baking bread at home'},
+            {'title': 'Bread recipes', 'content': 'Flour, water and salt'},
+            {'title': 'Gardening', 'content': 'Nothing about food'},
+        ]
+        response = self.client().post('/posts/bulk', headers=headers, data=json.dumps(posts))
+        self.assertEqual(response.status_code, 201)
+
+        response = self.client().get('/posts/search?q=bread', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in data.get('data')], [3, 2])
+
+        response = self.client().get('/posts/search?q=bread&per_page=1', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertIn('q=bread', data.get('next'))
+
+        patch_data = {'content': 'Bread in the garden'}
+        response = self.client().patch('/posts/4', headers=headers, data=json.dumps(patch_data))
+        self.assertEqual(response.status_code, 200)
+        response = self.client().delete('/posts/3', headers=headers)
+        self.assertEqual(response.status_code, 204)
+        response = self.client().get('/posts/search?q=bread', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertEqual([item['id'] for item in data.get('data')], [4, 2])
+
+    def test_blog_search_without_query(self):
+        """Test: search needs a query"""
+        response = self.client().get('/posts/search?q=', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client().get('/posts/search?q=%22%3F', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data.get('data'), [])
+
     def test_comment_create(self):
         """Test: create comment for post"""
         api_token = self.test_blog_create()
@@ -131,6 +349,39 @@ class PostsTest(unittest.TestCase):
         self.assertEqual(data.get('content'), 'My comment')
         return api_token
 
+    def test_comment_create_missing_post(self):
+        """Test: a comment of a missing post is rejected"""
+        api_token = self.test_blog_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        response = self.client().post('/comments/', headers=headers,
+                                      data=json.dumps({'content': 'Lost', 'post_id': 999}))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data.get('error'), {'post_id': ['999 does not exist.']})
+
+        self.client().post('/comments/', headers=headers, data=json.dumps(self.comment_data))
+        response = self.client().patch('/comments/1', headers=headers, data=json.dumps({'post_id': 999}))
+        self.assertEqual(response.status_code, 400)
+
+    def test_comment_list_fast_serialization(self):
+        """Test: lists serialized from rows are byte identical to marshmallow and jsonify"""
+        api_token = self.test_blog_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        for content in ('Plain', 'Caf\u00e9 \u2028 \U0001f600 \x7f <b>"quoted"</b>\n\ttab'):
+            comment_data = {'content': content, 'post_id': 1}
+            response = self.client().post('/comments/', headers=headers, data=json.dumps(comment_data))
+            self.assertEqual(response.status_code, 201)
+
+        self.app.config['RESPONSE_CACHE_ENABLED'] = False
+        for url in ('/comments/', '/comments/?per_page=1&page=2', '/comments/?cursor=', '/post-comments/1'):
+            fast = self.client().get(url, headers=self.headers)
+            self.app.config['FAST_SERIALIZATION'] = False
+            slow = self.client().get(url, headers=self.headers)
+            self.app.config['FAST_SERIALIZATION'] = True
+            self.assertEqual(fast.status_code, 200)
+            self.assertEqual(fast.data, slow.data)
+            self.assertEqual(fast.headers.get('ETag'), slow.headers.get('ETag'))
+
     def test_comment_create_without_credentials(self):
         """Test: create comment for post without credentials"""
         self.test_blog_create()
@@ -155,6 +406,118 @@ class PostsTest(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(data.get("data")), 1)
 
+    def test_blog_list_expand(self):
+        """Test: expand comments and author in the list of posts with a fixed number of queries"""
+        api_token = self.test_comment_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        for post_id in (2, 3):
+            response = self.client().post('/posts/', headers=headers, data=json.dumps(self.post_data))
+            self.assertEqual(response.status_code, 201)
+            comment_data = {'content': 'Another comment', 'post_id': post_id}
+            response = self.client().post('/comments/', headers=headers, data=json.dumps(comment_data))
+            self.assertEqual(response.status_code, 201)
+
+        statements = []
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        response = self.client().get('/posts/?expand=comments,author', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data.get('data')), 3)
+        for post in data.get('data'):
+            self.assertEqual(len(post.get('comments')), 1)
+            self.assertEqual(post.get('author').get('username'), 'test')
+            self.assertNotIn('email', post.get('author'))
+        # count, page with authors, comments of the page
+        self.assertEqual(len(statements), 3)
+
+        response = self.client().get('/posts/', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertNotIn('comments', data.get('data')[0])
+        self.assertNotIn('author', data.get('data')[0])
+        self.assertNotIn('has_more_comments', data.get('data')[0])
+
+    def test_blog_list_expand_limit(self):
+        """Test: the comments embedded in a list are capped, the post says when it has more"""
+        self.app.config['EXPAND_LIST_LIMIT'] = 1
+        self.app.config['RESPONSE_CACHE_ENABLED'] = False
+        api_token = self.test_comment_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        self.client().post('/posts/', headers=headers, data=json.dumps(self.post_data))
+        comments = [{'content': 'Second', 'post_id': 1}, {'content': 'Other', 'post_id': 2}]
+        self.client().post('/comments/bulk', headers=headers, data=json.dumps(comments))
+
+        response = self.client().get('/posts/?expand=comments', headers=self.headers)
+        data = json.loads(response.data).get('data')
+        self.assertEqual([[comment['content'] for comment in post['comments']] for post in data],
+                         [['My comment'], ['Other']])
+        self.assertEqual([post['has_more_comments'] for post in data], [True, False])
+        etag = response.headers.get('ETag')
+
+        self.client().post('/comments/', headers=headers, data=json.dumps({'content': 'More', 'post_id': 2}))
+        response = self.client().get('/posts/?expand=comments', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([post['has_more_comments'] for post in json.loads(response.data).get('data')], [True, True])
+
+        response = self.client().get('/posts/1?expand=comments', headers=self.headers)
+        self.assertEqual(len(json.loads(response.data).get('comments')), 2)
+
+    def test_blog_one_expand(self):
+        """Test: expand comments of one post"""
+        self.test_comment_create()
+        response = self.client().get('/posts/1?expand=comments', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data.get('comments')[0].get('content'), 'My comment')
+        self.assertNotIn('author', data)
+
+    def test_comment_bulk_create(self):
+        """Test: create many comments in one request"""
+        api_token = self.test_blog_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        comments = [
+            {'content': 'First', 'post_id': 1},
+            {'post_id': 1},
+            {'content': 'Third', 'post_id': 1, 'author_id': 5},
+        ]
+        response = self.client().post('/comments/bulk', headers=headers, data=json.dumps(comments))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data.get('ids'), [1, 2])
+        self.assertEqual(list(data.get('errors')), ['1'])
+        self.assertTrue(data.get('errors').get('1').get('content'))
+
+        response = self.client().get('/post-comments/1', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertEqual([item['content'] for item in data.get('data')], ['First', 'Third'])
+        self.assertEqual({item['author_id'] for item in data.get('data')}, {1})
+
+    def test_comment_bulk_create_invalid(self):
+        """Test: bulk create without valid items"""
+        api_token = self.test_blog_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        response = self.client().post('/comments/bulk', headers=headers, data=json.dumps(self.comment_data))
+        self.assertEqual(response.status_code, 400)
+        response = self.client().post('/comments/bulk', headers=headers, data=json.dumps([{'post_id': 1}]))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(data.get('error').get('0'))
+
+    def test_comment_bulk_create_missing_post(self):
+        """Test: items of a missing post are reported, the others are created"""
+        api_token = self.test_blog_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        comments = [{'content': 'First', 'post_id': 1}, {'content': 'Lost', 'post_id': 999},
+                    {'post_id': 1}, {'content': 'Second', 'post_id': 1}]
+        response = self.client().post('/comments/bulk', headers=headers, data=json.dumps(comments))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data.get('ids'), [1, 2])
+        self.assertEqual(sorted(data.get('errors')), ['1', '2'])
+        self.assertEqual(data.get('errors').get('1'), {'post_id': ['999 does not exist.']})
+        response = self.client().get('/posts/1', headers=self.headers)
+        self.assertEqual(json.loads(response.data).get('comment_count'), 2)
+
     def test_comment_delete(self):
         """Test: delete the comment"""
         api_token = self.test_comment_create()
@@ -175,6 +538,172 @@ class PostsTest(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(data.get("data")), 0)
 
+    def test_blog_comment_count(self):
+        """Test: posts count their comments, the cached post follows comment writes"""
+        api_token = self.test_comment_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        response = self.client().get('/posts/1', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertEqual(data.get('comment_count'), 1)
+        self.assertTrue(data.get('last_comment_at'))
+
+        comments = [{'content': 'Second', 'post_id': 1}, {'content': 'Third', 'post_id': 1}]
+        response = self.client().post('/comments/bulk', headers=headers, data=json.dumps(comments))
+        self.assertEqual(response.status_code, 201)
+        response = self.client().delete('/comments/1', headers=headers)
+        self.assertEqual(response.status_code, 204)
+
+        response = self.client().get('/posts/', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertEqual(data.get('data')[0].get('comment_count'), 2)
+        response = self.client().get('/posts/1', headers=self.headers)
+        self.assertEqual(json.loads(response.data).get('comment_count'), 2)
+
+    def test_repair_comment_counts(self):
+        """Test: the repair command recomputes drifted counters"""
+        self.test_comment_create()
+        with self.app.app_context():
+            db.session.execute(db.update(BlogPost).values(comment_count=7, last_comment_at=None))
+            db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=['repair-comment-counts'])
+        self.assertIn('Repaired 1 blog posts', result.output)
+        with self.app.app_context():
+            post = db.session.get(BlogPost, 1)
+            self.assertEqual(post.comment_count, 1)
+            self.assertIsNotNone(post.last_comment_at)
+
+    def test_blog_delete_cascades(self):
+        """Test: deleting a post deletes its comments"""
+        api_token = self.test_comment_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        response = self.client().get('/comments/1', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        response = self.client().delete('/posts/1', headers=headers)
+        self.assertEqual(response.status_code, 204)
+        # the cached comment went with the post
+        response = self.client().get('/comments/1', headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+        with self.app.app_context():
+            self.assertEqual(db.session.scalar(db.select(db.func.count(Comment.id))), 0)
+
+    def test_blog_delete_large_post(self):
+        """Test: a post with many comments is hidden at once and purged in batches"""
+        self.app.config['POST_DELETE_CASCADE_LIMIT'] = 1
+        api_token = self.test_comment_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        comments = [{'content': 'Second', 'post_id': 1}, {'content': 'Third', 'post_id': 1}]
+        self.client().post('/comments/bulk', headers=headers, data=json.dumps(comments))
+        response = self.client().get('/comments/1', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client().delete('/posts/1', headers=headers)
+        self.assertEqual(response.status_code, 204)
+        response = self.client().get('/posts/1', headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+        response = self.client().get('/posts/', headers=self.headers)
+        self.assertEqual(json.loads(response.data).get('data'), [])
+        response = self.client().delete('/posts/1', headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+        # its comments are hidden too and it takes no new ones
+        for url in ('/comments/', '/post-comments/1'):
+            response = self.client().get(url, headers=self.headers)
+            self.assertEqual(json.loads(response.data).get('data'), [])
+        response = self.client().get('/comments/2', headers=headers)
+        self.assertEqual(response.status_code, 404)
+        response = self.client().post('/comments/', headers=headers, data=json.dumps(self.comment_data))
+        self.assertEqual(response.status_code, 400)
+        response = self.client().post('/comments/bulk', headers=headers, data=json.dumps(comments))
+        self.assertEqual(json.loads(response.data).get('error'), {str(index): {'post_id': ['1 does not exist.']}
+                                                                  for index in range(2)})
+
+        result = self.app.test_cli_runner().invoke(args=['cleanup-comments', '--batch-size', '2', '--orphans'])
+        self.assertIn('Deleted 1 blog posts and 3 comments', result.output)
+        response = self.client().get('/comments/1', headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+        with self.app.app_context():
+            self.assertEqual(db.session.scalar(db.select(db.func.count(Comment.id))), 0)
+            posts = db.select(db.func.count(BlogPost.id)).execution_options(include_deleted=True)
+            self.assertEqual(db.session.scalar(posts), 0)
+
+    def test_export(self):
+        """Test: stream posts and comments as NDJSON or CSV, filtered and resumed"""
+        self.app.config['EXPORT_BATCH_SIZE'] = 2
+        api_token = self.test_comment_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        self.client().post('/posts/', headers=headers, data=json.dumps(self.post_data))
+        comments = [{'content': f'Comment {index}', 'post_id': 1 + index % 2} for index in range(4)]
+        self.client().post('/comments/bulk', headers=headers, data=json.dumps(comments))
+
+        response = self.client().get('/comments/export')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertTrue(response.is_streamed)
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([line['id'] for line in lines], [1, 2, 3, 4, 5])
+        self.assertEqual(lines[0]['content'], 'My comment')
+
+        response = self.client().get('/comments/export?post_id=1&after=2')
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([line['id'] for line in lines], [4])
+
+        response = self.client().get('/posts/export?format=csv&author_id=1')
+        self.assertEqual(response.mimetype, 'text/csv')
+        rows = response.data.decode().splitlines()
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(rows[0].startswith('id,title,content,author_id'))
+        response = self.client().get('/posts/export?format=csv&since=2999-01-01')
+        self.assertEqual(len(response.data.decode().splitlines()), 1)
+
+        response = self.client().get('/posts/export?format=xml')
+        self.assertEqual(response.status_code, 400)
+        response = self.client().get('/posts/export?since=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+    def test_unit_of_work(self):
+        """Test: writes in a unit of work are committed once, or not at all"""
+        self.test_comment_create()
+        commits = []
+        with self.app.app_context():
+            event.listen(db.session, 'after_commit', commits.append)
+            with unit_of_work():
+                post = db.session.get(BlogPost, 1)
+                post.update({'title': 'Changed'})
+                Comment(content='Second', post_id=1, author_id=1).save()
+                db.session.get(Comment, 1).update({'content': 'Changed'})
+            self.assertEqual(len(commits), 1)
+
+            with self.assertRaises(RuntimeError):
+                with unit_of_work():
+                    db.session.get(BlogPost, 1).update({'title': 'Rolled back'})
+                    raise RuntimeError()
+            self.assertEqual(len(commits), 1)
+            self.assertEqual(db.session.get(BlogPost, 1).title, 'Changed')
+            self.assertEqual(db.session.get(BlogPost, 1).comment_count, 2)
+
+    def test_update_and_delete_where(self):
+        """Test: single statement updates and deletes keep the comment counters right"""
+        api_token = self.test_comment_create()
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        self.client().post('/posts/', headers=headers, data=json.dumps(self.post_data))
+        comments = [{'content': 'Second', 'post_id': 1}, {'content': 'Third', 'post_id': 1}]
+        self.client().post('/comments/bulk', headers=headers, data=json.dumps(comments))
+        with self.app.app_context():
+            ids = BlogPost.update_where(BlogPost.author_id == 1, title='Renamed')
+            self.assertEqual(sorted(ids), [1, 2])
+            ids = Comment.update_where(Comment.id.in_([1, 2]), post_id=2)
+            self.assertEqual(sorted(ids), [1, 2])
+            self.assertEqual(Comment.delete_where(Comment.id == 3), [3])
+
+        response = self.client().get('/posts/1', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertEqual(data.get('title'), 'Renamed')
+        self.assertEqual(data.get('comment_count'), 0)
+        self.assertIsNone(data.get('last_comment_at'))
+        response = self.client().get('/posts/2', headers=self.headers)
+        self.assertEqual(json.loads(response.data).get('comment_count'), 2)
+
     def tearDown(self):
         with self.app.app_context():
             db.session.remove()
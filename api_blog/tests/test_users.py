@@ -1,7 +1,17 @@
+import os
+import time
+import threading
 import unittest
+from unittest import mock
 import json
 from ..app import create_app
-from ..models import db
+from ..config import app_config, Test, concurrency_limits
+from sqlalchemy import event
+from ..models import db, User, BlogPost
+from ..ratelimit import parse_limit
+from ..hashing import hasher, hash_rounds, HashPool, HashingBusy
+from ..cache import MemoryBackend
+from ..tokens import Keyset, BloomFilter, RevocationList
 
 
 class UsersTest(unittest.TestCase):
@@ -57,6 +67,22 @@ class UsersTest(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertTrue(data.get('error'))
 
+    def test_user_create_race(self):
+        """Test: a signup losing the race to the same email gets an error, not a 500"""
+        generate_hash = hasher.generate_hash
+
+        def signup_meanwhile(password):
+            # another signup commits while this one is hashing its password
+            with db.engine.begin() as connection:
+                connection.execute(db.insert(User), {'username': 'other', 'email': 'test@test.com'})
+            return generate_hash(password)
+
+        with mock.patch.object(hasher, 'generate_hash', side_effect=signup_meanwhile):
+            response = self.client().post('/users/', headers=self.headers, data=json.dumps(self.user_data))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data.get('error'), 'User with this email already exist, please use another email.')
+
     def test_user_create_with_no_data(self):
         """Test create user with no data"""
         user = {}
@@ -125,6 +151,137 @@ class UsersTest(unittest.TestCase):
         self.assertEqual(data.get('error'), 'Invalid credentials')
         self.assertEqual(response.status_code, 400)
 
+    def test_user_login_when_hashing_is_saturated(self):
+        """User Login Tests when too many hashes are in progress"""
+        response = self.client().post('/users/', headers=self.headers, data=json.dumps(self.user_data))
+        self.assertEqual(response.status_code, 201)
+        with self.app.app_context():
+            self.app.extensions['password_hasher']._slots = threading.BoundedSemaphore(1)
+            self.app.extensions['password_hasher']._slots.acquire()
+        response = self.client().post('/users/login', headers=self.headers, data=json.dumps(self.user_data))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get('Retry-After'), '1')
+        self.assertTrue(data.get('error'))
+
+    def test_user_login_rate_limited(self):
+        """User Login Tests: a client over its rate limit is turned away before any query or hash"""
+        response = self.client().post('/users/', headers=self.headers, data=json.dumps(self.user_data))
+        self.assertEqual(response.status_code, 201)
+        self.app.config['RATE_LIMIT_ENABLED'] = True
+        self.app.extensions['rate_limit']['limits']['auth'] = parse_limit('2/minute')
+        for _ in range(2):
+            response = self.client().post('/users/login', headers=self.headers, data=json.dumps(self.user_data))
+            self.assertEqual(response.status_code, 200)
+
+        statements = []
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        response = self.client().post('/users/login', headers=self.headers, data=json.dumps(self.user_data))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers.get('Retry-After'), '30')
+        self.assertEqual(statements, [])
+
+    def test_user_login_concurrency_limited(self):
+        """User Login Tests: requests past the concurrency limit of their endpoint class are rejected"""
+        self.app.extensions['rate_limit']['slots']['auth'] = threading.BoundedSemaphore(1)
+        self.app.extensions['rate_limit']['slots']['auth'].acquire()
+        response = self.client().post('/users/login', headers=self.headers, data=json.dumps(self.user_data))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get('Retry-After'), '1')
+        response = self.client().get('/posts/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_user_logins_leave_threads_to_reads_and_writes(self):
+        """User Login Tests: logins holding all their slots do not keep reads and writes waiting"""
+        limits = concurrency_limits(4)
+        self.assertTrue(all(limit < 4 for limit in limits.values()))
+
+        class Threaded(Test):
+            WEB_THREADS = 4
+            CONCURRENCY_LIMITS = limits
+        app_config['test_threaded'] = Threaded
+        self.addCleanup(app_config.pop, 'test_threaded')
+        app = create_app('test_threaded')
+        response = app.test_client().post('/users/', headers=self.headers, data=json.dumps(self.user_data))
+        headers = {'Content-Type': 'application/json', 'api-token': json.loads(response.data).get('jwt_token')}
+
+        started, release, statuses = threading.Semaphore(0), threading.Event(), []
+        check_hash = hasher.check_hash
+
+        def slow_check_hash(*args):
+            started.release()
+            release.wait(5)
+            return check_hash(*args)
+
+        def login():
+            response = app.test_client().post('/users/login', headers=self.headers, data=json.dumps(self.user_data))
+            statuses.append(response.status_code)
+
+        with mock.patch.object(hasher, 'check_hash', side_effect=slow_check_hash):
+            logins = [threading.Thread(target=login) for _ in range(limits['auth'])]
+            for thread in logins:
+                thread.start()
+            for _ in logins:
+                self.assertTrue(started.acquire(timeout=5))
+            login()
+            self.assertEqual(statuses, [503])
+            self.assertEqual(app.test_client().get('/posts/').status_code, 200)
+            response = app.test_client().post('/posts/', headers=headers,
+                                              data=json.dumps({'title': 'Title', 'content': 'Content'}))
+            self.assertEqual(response.status_code, 201)
+            release.set()
+            for thread in logins:
+                thread.join()
+        self.assertEqual(statuses, [503] + [200] * limits['auth'])
+
+    def test_user_login_upgrades_hash(self):
+        """User Login Tests: the password is re-hashed when the rounds change"""
+        response = self.client().post('/users/', headers=self.headers, data=json.dumps(self.user_data))
+        self.assertEqual(response.status_code, 201)
+        self.app.config['BCRYPT_LOG_ROUNDS'] = 5
+        response = self.client().post('/users/login', headers=self.headers, data=json.dumps(self.user_data))
+        self.assertEqual(response.status_code, 200)
+        # The upgrade runs once the server closes the response
+        response.close()
+        with self.app.app_context():
+            user = db.session.get(User, 1)
+            self.assertTrue(user.password_hash.startswith('$2b$05$'))
+            self.assertTrue(user.check_hash(self.user_data['password']))
+
+    def test_user_login_with_hash_workers(self):
+        """User Login Tests: hashes, checks and upgrades run in the process pool"""
+        class HashWorkers(Test):
+            BCRYPT_POOL_WORKERS = 1
+            BCRYPT_POOL_MAX_PENDING = 1
+        app_config['test_hash_workers'] = HashWorkers
+        self.addCleanup(app_config.pop, 'test_hash_workers')
+        app = create_app('test_hash_workers')
+        pool = app.extensions['password_hasher']
+        self.addCleanup(pool.shutdown)
+        client = app.test_client()
+
+        response = client.post('/users/', headers=self.headers, data=json.dumps(self.user_data))
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNotNone(pool._executor)
+        response = client.post('/users/login', headers=self.headers,
+                               data=json.dumps(dict(self.user_data, password='wrong_password')))
+        self.assertEqual(response.status_code, 400)
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        response = client.post('/users/login', headers=self.headers, data=json.dumps(self.user_data))
+        self.assertEqual(response.status_code, 200)
+        # the upgrade is submitted to the pool, shutting it down waits for it
+        pool.shutdown()
+        with app.app_context():
+            self.assertTrue(db.session.get(User, 1).password_hash.startswith('$2b$05$'))
+
+        pool._slots.acquire()
+        self.addCleanup(pool._slots.release)
+        response = client.post('/users/login', headers=self.headers, data=json.dumps(self.user_data))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get('Retry-After'), '1')
+
     def test_user_get_me(self):
         """Test" Get info about my user"""
         response = self.client().post('/users/', headers=self.headers, data=json.dumps(self.user_data))
@@ -154,6 +311,91 @@ class UsersTest(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(data.get('data')), 1)
 
+    def test_user_deleted_invalidates_identity(self):
+        """Test: a cached identity is dropped when the user is deleted"""
+        response = self.client().post('/users/', headers=self.headers, data=json.dumps(self.user_data))
+        self.assertEqual(response.status_code, 201)
+        api_token = json.loads(response.data).get('jwt_token')
+        headers = {'Content-Type': 'application/json', 'api-token': api_token}
+        response = self.client().get('/users/', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        with self.app.app_context():
+            db.session.get(User, 1).delete()
+
+        response = self.client().get('/users/', headers=headers)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data.get('error'), 'User does not exist, invalid token')
+
+    def test_user_logout(self):
+        """Test: a token is rejected after logging out with it, other tokens still work"""
+        response = self.client().post('/users/', headers=self.headers, data=json.dumps(self.user_data))
+        api_token = json.loads(response.data).get('jwt_token')
+        response = self.client().post('/users/login', headers=self.headers, data=json.dumps(self.user_data))
+        other_token = json.loads(response.data).get('jwt_token')
+
+        response = self.client().post('/users/logout', headers={'api-token': api_token})
+        self.assertEqual(response.status_code, 200)
+        response = self.client().get('/users/me', headers={'api-token': api_token})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data.get('error'), 'Token revoked, please login again')
+        response = self.client().get('/users/me', headers={'api-token': other_token})
+        self.assertEqual(response.status_code, 200)
+
+    def test_user_stateless_token(self):
+        """Test: in stateless mode authenticated requests do not read the users table"""
+        self.app.config['JWT_STATELESS'] = True
+        response = self.client().post('/users/', headers=self.headers, data=json.dumps(self.user_data))
+        api_token = json.loads(response.data).get('jwt_token')
+
+        statements = []
+        with self.app.app_context():
+            engine = db.engine
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            response = self.client().post('/posts/', headers={'api-token': api_token},
+                                          json={'title': 'Title', 'content': 'Content'})
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse([statement for statement in statements if 'FROM users' in statement])
+
+        # deleting the user revokes the tokens it was issued
+        with self.app.app_context():
+            BlogPost.delete_where(BlogPost.author_id == 1)
+            db.session.get(User, 1).delete()
+        response = self.client().get('/users/me', headers={'api-token': api_token})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data.get('error'), 'Token revoked, please login again')
+
+    def test_user_token_key_rotation(self):
+        """Test: tokens signed with a previous key stay valid until the key is removed"""
+        response = self.client().post('/users/', headers=self.headers, data=json.dumps(self.user_data))
+        old_token = json.loads(response.data).get('jwt_token')
+
+        self.app.extensions['tokens']['keyset'] = Keyset([
+            {'kid': 'new', 'alg': 'HS512', 'key': 'new secret'},
+            {'kid': 'default', 'alg': 'HS256', 'key': self.app.config['JWT_SECRET_KEY']},
+        ])
+        response = self.client().post('/users/login', headers=self.headers, data=json.dumps(self.user_data))
+        new_token = json.loads(response.data).get('jwt_token')
+        for token in (old_token, new_token):
+            response = self.client().get('/users/me', headers={'api-token': token})
+            self.assertEqual(response.status_code, 200)
+
+        self.app.extensions['tokens']['keyset'] = Keyset([{'kid': 'new', 'alg': 'HS512', 'key': 'new secret'}])
+        response = self.client().get('/users/me', headers={'api-token': old_token})
+        self.assertEqual(response.status_code, 400)
+        response = self.client().get('/users/me', headers={'api-token': new_token})
+        self.assertEqual(response.status_code, 200)
+
     def tearDown(self):
         """
         Tear Down
@@ -163,5 +405,70 @@ class UsersTest(unittest.TestCase):
             db.drop_all()
 
 
+def exit_worker():
+    os._exit(1)
+
+
+class HashPoolTest(unittest.TestCase):
+    """Process pool of the password hashes"""
+
+    def test_broken_pool(self):
+        pool = HashPool(workers=1, max_pending=1)
+        self.addCleanup(pool.shutdown)
+        # a dead worker process answers busy once, the next hash gets a new pool
+        with self.assertRaises(HashingBusy):
+            pool.run(exit_worker)
+        self.assertEqual(pool.run(hash_rounds, '$2b$04$salt'), 4)
+
+        # a failed submit gives its slot back
+        with mock.patch.object(pool.executor, 'submit', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                pool.submit(hash_rounds, '$2b$04$salt', callback=print)
+        self.assertEqual(pool.run(hash_rounds, '$2b$04$salt'), 4)
+
+
+class BloomFilterTest(unittest.TestCase):
+    """Bloom filter of the token revocation list"""
+
+    def test_membership(self):
+        bloom = BloomFilter(1000)
+        keys = [f'jti:{index}' for index in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        false_positives = sum(f'other:{index}' in bloom for index in range(10000))
+        self.assertLess(false_positives, 50)
+
+
+class RevocationListTest(unittest.TestCase):
+    """Token revocation list shared by the workers"""
+
+    def test_sync(self):
+        backend = MemoryBackend()
+        first = RevocationList(backend, capacity=100)
+        first.revoke('jti:a', True, time.time() + 60)
+        first.revoke('jti:expired', True, time.time() - 1)
+
+        # a new worker reads the log on start, then only every sync_interval
+        second = RevocationList(backend, capacity=100, sync_interval=60)
+        self.assertTrue(second.get('jti:a'))
+        self.assertIsNone(second.get('jti:expired'))
+        with mock.patch.object(backend, 'since') as since:
+            first.revoke('jti:b', True, time.time() + 60)
+            self.assertIsNone(second.get('jti:b'))
+            since.assert_not_called()
+        second._next_sync = 0
+        self.assertTrue(second.get('jti:b'))
+        self.assertTrue(first.get('jti:b'))
+
+    def test_log_retention(self):
+        backend = MemoryBackend()
+        revoked = RevocationList(backend, capacity=100, retention=10)
+        revoked.revoke('jti:a', True, time.time() + 60)
+        with mock.patch('time.time', return_value=time.time() + 20):
+            revoked.revoke('jti:b', True, time.time() + 60)
+        self.assertEqual([value[0] for value, _ in backend.since('revoked', 0)], ['jti:b'])
+
+
 if __name__ == "__main__":
     unittest.main()
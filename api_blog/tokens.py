@@ -0,0 +1,237 @@
+import math
+import time
+import uuid
+import hashlib
+import datetime
+import threading
+
+import jwt
+from jwt.algorithms import get_default_algorithms
+from flask import current_app
+
+from .cache import create_backend
+
+
+class RevokedTokenError(jwt.InvalidTokenError):
+    """Raised for a token revoked by a logout, or issued to a deleted user"""
+
+
+class BloomFilter(object):
+    """Set membership with false positives but no false negatives, in capacity * ~14 bits for 0.1%"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationList(object):
+    """
+    Revoked keys (token ids and users) until the tokens they cover expire.
+    A bloom filter answers most checks without looking at the exact entries. Every worker
+    keeps all the entries: revocations are appended to a log in the shared backend (Redis),
+    which each worker reads on start and then every sync_interval seconds, so a check
+    never waits on the backend and a token revoked by another worker is refused within sync_interval.
+    """
+
+    LOG_KEY = 'revoked'
+    # revocations are logged with the clock of their worker, the log is read back this far to allow for skew
+    CLOCK_SKEW = 5
+
+    def __init__(self, backend=None, capacity=100000, error_rate=0.001, retention=86400, sync_interval=1):
+        self.backend = backend
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.retention = retention
+        self.sync_interval = sync_interval
+        self._entries = {}
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._lock = threading.Lock()
+        self._synced_to = 0
+        self._next_sync = 0
+
+    def revoke(self, key, value, expires_at):
+        """Revoke key until expires_at (epoch seconds), value is returned by get"""
+        now = time.time()
+        if expires_at <= now:
+            return
+        self._add(key, value, expires_at)
+        if self.backend is not None:
+            self.backend.append(self.LOG_KEY, [key, value, expires_at], now, keep_after=now - self.retention)
+
+    def get(self, key):
+        self._sync()
+        if key not in self._bloom:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    def _add(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._bloom.add(key)
+            if len(self._entries) > self.capacity:
+                self._rebuild()
+
+    def _sync(self):
+        """Add the revocations logged by the other workers since the last sync"""
+        if self.backend is None:
+            return
+        with self._lock:
+            if time.monotonic() < self._next_sync:
+                return
+            self._next_sync = time.monotonic() + self.sync_interval
+            since = self._synced_to - self.CLOCK_SKEW
+        now = time.time()
+        for (key, value, expires_at), score in self.backend.since(self.LOG_KEY, since):
+            if expires_at > now:
+                self._add(key, value, expires_at)
+            with self._lock:
+                self._synced_to = max(self._synced_to, score)
+
+    def _rebuild(self):
+        # a bloom filter can not forget keys, drop the expired entries and start a new one
+        now = time.time()
+        self._entries = {key: entry for key, entry in self._entries.items() if entry[1] > now}
+        self.capacity = max(self.capacity, 2 * len(self._entries))
+        self._bloom = BloomFilter(self.capacity, self.error_rate)
+        for key in self._entries:
+            self._bloom.add(key)
+
+
+class Keyset(object):
+    """
+    The key new tokens are signed with and the older keys still accepted, by key id.
+    Keys are parsed once, PyJWT would otherwise load a PEM key on every call.
+    """
+
+    def __init__(self, keys, active_kid=None):
+        if not keys:
+            raise ValueError('No JWT signing key, set JWT_SECRET_KEY or JWT_KEYS')
+        algorithms = get_default_algorithms()
+        self.keys = {}
+        for key in keys:
+            if key['alg'] not in algorithms or key['alg'] == 'none':
+                raise ValueError(f'Unsupported JWT algorithm {key["alg"]!r}, '
+                                 f'RS256 and EdDSA need the cryptography package')
+            algorithm = algorithms[key['alg']]
+            signing_key = algorithm.prepare_key(key['key'])
+            verifying_key = key.get('public_key')
+            if verifying_key is not None:
+                verifying_key = algorithm.prepare_key(verifying_key)
+            elif hasattr(signing_key, 'public_key'):
+                verifying_key = signing_key.public_key()
+            else:
+                verifying_key = signing_key
+            self.keys[key['kid']] = (key['alg'], signing_key, verifying_key)
+        self.active_kid = active_kid or keys[0]['kid']
+        if self.active_kid not in self.keys:
+            raise ValueError(f'JWT_ACTIVE_KID {self.active_kid!r} is not one of JWT_KEYS')
+
+    @classmethod
+    def from_config(cls, config):
+        keys = []
+        for key in config['JWT_KEYS']:
+            key = dict(key)
+            if 'key_file' in key:
+                with open(key.pop('key_file')) as key_file:
+                    key['key'] = key_file.read()
+            keys.append(key)
+        if not keys and config.get('JWT_SECRET_KEY'):
+            keys = [{'kid': 'default', 'alg': 'HS256', 'key': config['JWT_SECRET_KEY']}]
+        return cls(keys, config.get('JWT_ACTIVE_KID'))
+
+    def encode(self, payload):
+        alg, signing_key, _ = self.keys[self.active_kid]
+        return jwt.encode(payload, signing_key, alg, headers={'kid': self.active_kid})
+
+    def decode(self, token):
+        # tokens issued before key ids were added carry none, they were signed with the active key
+        kid = jwt.get_unverified_header(token).get('kid', self.active_kid)
+        if kid not in self.keys:
+            raise jwt.InvalidTokenError(f'Unknown key id {kid!r}')
+        alg, _, verifying_key = self.keys[kid]
+        return jwt.decode(token, verifying_key, algorithms=[alg])
+
+
+class TokenManager(object):
+    """
+    Issues and checks the api tokens. With JWT_STATELESS the token alone identifies
+    the user: auth_required trusts its claims and the users table is not read.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JWT_KEYS', [])
+        app.config.setdefault('JWT_EXPIRES', 86400)
+        app.config.setdefault('JWT_STATELESS', False)
+        app.config.setdefault('TOKEN_REVOCATION_CAPACITY', 100000)
+        app.config.setdefault('TOKEN_REVOCATION_SYNC_INTERVAL', 1)
+        backend = None
+        if app.config.get('TOKEN_REVOCATION_BACKEND') is not None or app.config.get('TOKEN_REVOCATION_REDIS_URL'):
+            backend = create_backend(app, 'TOKEN_REVOCATION')
+        app.extensions['tokens'] = {
+            'keyset': Keyset.from_config(app.config),
+            'revoked': RevocationList(backend, capacity=app.config['TOKEN_REVOCATION_CAPACITY'],
+                                      retention=app.config['JWT_EXPIRES'],
+                                      sync_interval=app.config['TOKEN_REVOCATION_SYNC_INTERVAL']),
+        }
+
+    @property
+    def state(self):
+        return current_app.extensions['tokens']
+
+    def generate(self, user_id):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return self.state['keyset'].encode({
+            'sub': user_id,
+            'iat': now,
+            'exp': now + datetime.timedelta(seconds=current_app.config['JWT_EXPIRES']),
+            'jti': uuid.uuid4().hex,
+        })
+
+    def decode(self, token):
+        """The claims of a valid token, raises a jwt.InvalidTokenError otherwise"""
+        claims = self.state['keyset'].decode(token)
+        revoked = self.state['revoked']
+        if claims.get('jti') and revoked.get(f'jti:{claims["jti"]}') is not None:
+            raise RevokedTokenError('Token revoked')
+        revoked_at = revoked.get(f'user:{claims["sub"]}')
+        if revoked_at is not None and claims.get('iat', 0) <= revoked_at:
+            raise RevokedTokenError('Token revoked')
+        return claims
+
+    def revoke(self, claims):
+        """Revoke one token until it expires"""
+        self.state['revoked'].revoke(f'jti:{claims["jti"]}', True, claims['exp'])
+
+    def revoke_user(self, user_id):
+        """
+        Revoke the tokens issued to a user so far. Only needed by stateless mode,
+        otherwise auth_required finds out from the users table.
+        """
+        if not current_app.config['JWT_STATELESS']:
+            return
+        now = time.time()
+        self.state['revoked'].revoke(f'user:{user_id}', math.ceil(now), now + current_app.config['JWT_EXPIRES'])
+
+
+tokens = TokenManager()
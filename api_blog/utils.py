@@ -1,37 +1,64 @@
-import os
+import re
 import jwt
+import json
+import base64
+import binascii
+import hashlib
 import datetime
-from flask import request, g, jsonify
-from functools import wraps
+from flask import request, g, jsonify, abort, current_app, Response
+from functools import wraps, lru_cache
+from urllib.parse import urlencode
+from werkzeug.http import quote_etag, unquote_etag
+from flask_sqlalchemy.pagination import SelectPagination
+from marshmallow import fields
+from sqlalchemy import tuple_, func, select
+from sqlalchemy.orm import selectinload, joinedload, aliased
+from sqlalchemy.orm.attributes import set_committed_value
 from .models import db, User
+from .cache import identity_cache
+from .replicas import PRIMARY_COOKIE
+from .profiling import timed
+from .tokens import tokens, RevokedTokenError
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
 
-JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY')
+
+NON_ASCII = re.compile('[^\x00-\x7e]')
 
 
 def error_response(message, code=400):
     return jsonify({'error': message}), code
 
 
+def json_response(data, code=200):
+    """Same bytes as jsonify, encoded with orjson when it is installed"""
+    if orjson is None or current_app.debug:
+        return jsonify(data), code
+    body = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    if not body.isascii() or b'\x7f' in body:
+        # jsonify escapes everything outside printable ASCII
+        body = NON_ASCII.sub(lambda match: json.dumps(match.group())[1:-1], body.decode()).encode()
+    return current_app.response_class(body + b'\n', status=code, mimetype=current_app.json.mimetype)
+
+
 def generate_token(user_id):
     """Generate Token"""
-    now = datetime.datetime.utcnow()
-    data = {
-        'sub': user_id,
-        'iat': now,
-        'exp': now + datetime.timedelta(days=1),
-    }
-    return jwt.encode(data, JWT_SECRET_KEY, 'HS256')
+    return tokens.generate(user_id)
 
 
 def decode_token(token):
     """Decode token method"""
     response = {}
     try:
-        data = jwt.decode(token, JWT_SECRET_KEY, 'HS256')
-        response = {'user_id': data['sub']}
+        data = tokens.decode(token)
+        response = {'user_id': data['sub'], 'claims': data}
     except jwt.ExpiredSignatureError:
         response = {'error': 'Token expired, please login again'}
+    except RevokedTokenError:
+        response = {'error': 'Token revoked, please login again'}
     except jwt.InvalidTokenError:
         response = {'error': 'Invalid token, please try again with a new token'}
     return response
@@ -52,16 +79,303 @@ def auth_required(func):
         if error_message:
             return error_response(error_message)
 
-        user = db.session.get(User, data['user_id'])
-        if not user:
-            message = 'User does not exist, invalid token'
-            return error_response(message)
-        g.user = {'id': user.id}
+        user_id = data['user_id']
+
+        if current_app.config['JWT_STATELESS']:
+            identity = {'id': user_id}
+        else:
+            identity = identity_cache.get(user_id)
+        if identity is None:
+            user = db.session.get(User, user_id)
+            if not user:
+                message = 'User does not exist, invalid token'
+                return error_response(message)
+            identity = {'id': user.id}
+            identity_cache.set(user.id, identity)
+        g.user = identity
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def if_match_versions():
+    """
+    Item versions accepted by the If-Match header of the request, sent as the ETag of a read
+    or of a write of the item ("3-<digest>", or just "3"), or None to write whatever the version is
+    """
+    if not request.headers.get('If-Match') or request.if_match.star_tag:
+        return None
+    versions = [tag.split('-', 1)[0] for tag in request.if_match.as_set()]
+    return [int(version) for version in versions if version.isdigit()]
+
+
+def read_replica(func):
+    """Send the SELECTs of a GET handler to a read replica, unless the client wrote recently"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if request.method == 'GET' and PRIMARY_COOKIE not in request.cookies:
+            db.session.info['use_replica'] = True
         return func(*args, **kwargs)
     return wrapper
 
 
-def pagination(req, db_select, schema):
+def remember_writes(response):
+    """Keep the client on the primary for REPLICA_MAX_LAG seconds after it wrote something"""
+    replicas = current_app.extensions.get('replicas')
+    if replicas and replicas.engines and db.session.info.get('wrote'):
+        response.set_cookie(PRIMARY_COOKIE, '1', max_age=current_app.config['REPLICA_MAX_LAG'], httponly=True)
+    return response
+
+
+def expandable_fields(schema_class):
+    """Names of the nested fields of a schema, dumped only when asked for with ?expand="""
+    return tuple(name for name, field in schema_class._declared_fields.items() if isinstance(field, fields.Nested))
+
+
+@lru_cache(maxsize=None)
+def expanded_schema(schema_class, expand=frozenset()):
+    """Schema instance that dumps the nested fields in expand and leaves the others out"""
+    return schema_class(exclude=[name for name in expandable_fields(schema_class) if name not in expand])
+
+
+def expand_options(req, model, schema_class, many=False):
+    """
+    Parse ?expand=a,b into eager loader options for the model relationships
+    and the schema to dump them with. For a list (many) the collections are left
+    to load_expanded, which caps them.
+    """
+    requested = {name.strip() for name in req.args.get('expand', '').split(',')}
+    expand = frozenset(requested.intersection(expandable_fields(schema_class)))
+    options = []
+    for name in sorted(expand):
+        relationship = getattr(model, name)
+        if relationship.property.uselist:
+            if not many:
+                options.append(selectinload(relationship))
+        else:
+            options.append(joinedload(relationship))
+    return options, expanded_schema(schema_class, expand)
+
+
+def load_expanded(items, schema):
+    """
+    Load the collections schema embeds for a page of items, EXPAND_LIST_LIMIT objects per item
+    at most, in creation order and with one query per collection.
+    Return {collection name: ids of the items with more objects than embedded}
+    """
+    limit = current_app.config.get('EXPAND_LIST_LIMIT', 10)
+    more = {}
+    for name, field in schema.dump_fields.items():
+        if not (isinstance(field, fields.Nested) and field.many) or not items:
+            continue
+        more[name] = set()
+        prop = getattr(type(items[0]), name).property
+        (local, remote), = prop.local_remote_pairs
+        target = prop.mapper.class_
+        rank = func.row_number().over(partition_by=remote, order_by=(target.created_at, target.id)).label('rank')
+        ranked = (select(target, rank)
+                  .where(remote.in_({getattr(item, local.key) for item in items}))
+                  .subquery())
+        related = aliased(target, ranked)
+        by_parent = {}
+        for obj in db.session.scalars(select(related).where(ranked.c.rank <= limit + 1).order_by(ranked.c.rank)):
+            by_parent.setdefault(getattr(obj, remote.key), []).append(obj)
+        for item in items:
+            objs = by_parent.get(getattr(item, local.key), [])
+            set_committed_value(item, name, objs[:limit])
+            if len(objs) > limit:
+                more[name].add(item.id)
+    return more
+
+
+def _versions(item, schema, model=None):
+    """Yield (model, id, last change) of item and of the related objects the schema embeds"""
+    yield (model or type(item)).__name__, item.id, item.updated_at or item.created_at
+    for name, field in schema.dump_fields.items():
+        if isinstance(field, fields.Nested):
+            related = getattr(item, name)
+            for obj in (related if field.many else [related] if related is not None else []):
+                yield from _versions(obj, field.schema)
+
+
+def _digest(items, schema, extra='', model=None):
+    """Digest of the last changes of items and of what the schema embeds, and the latest of them"""
+    digest = hashlib.sha1(extra.encode())
+    last_modified = None
+    for item in items:
+        for model_name, item_id, changed in _versions(item, schema, model):
+            digest.update(f'|{model_name}:{item_id}:{changed.isoformat() if changed else ""}'.encode())
+            if changed and (last_modified is None or changed > last_modified):
+                last_modified = changed
+    return digest.hexdigest(), last_modified
+
+
+def item_etag(item, schema, model=None):
+    """
+    Strong ETag of a single item, "<version>-<digest>". If-Match only compares the version,
+    the digest follows what changes without it (comment counters, expanded relations)
+    """
+    return quote_etag(f'{item.version}-{_digest([item], schema, model=model)[0][:16]}')
+
+
+def conditional_get(items, schema, extra='', model=None, single=False):
+    """
+    Compute an ETag and Last-Modified for items dumped with schema
+    and answer 304 straight away when the client copy is still fresh.
+    The ETag of a single item is strong so it can be sent back in If-Match,
+    the ETag of a page is weak. The validators are added to the response by add_cache_headers.
+    """
+    digest, last_modified = _digest(items, schema, extra, model)
+    etag = item_etag(items[0], schema, model) if single else quote_etag(digest, weak=True)
+    if last_modified:
+        last_modified = last_modified.replace(tzinfo=datetime.timezone.utc, microsecond=0)
+    g.cache_validators = (etag, last_modified)
+
+    # If-Modified-Since alone is not trusted, a deleted item does not move Last-Modified
+    if request.if_none_match.contains_weak(unquote_etag(etag)[0]):
+        abort(add_cache_headers(Response(status=304)))
+
+
+def add_cache_headers(response):
+    """Add the validators of conditional_get and Cache-Control to GET responses"""
+    validators = g.get('cache_validators')
+    if validators is None or request.method != 'GET' or response.status_code not in (200, 304):
+        return response
+    etag, last_modified = validators
+    response.headers['ETag'] = etag
+    if last_modified:
+        response.last_modified = last_modified
+    if 'api-token' in request.headers:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get('HTTP_CACHE_MAX_AGE', 0)
+    response.cache_control.must_revalidate = True
+    return response
+
+
+def encode_cursor(item, direction):
+    """Encode the (created_at, id) key of item into an opaque cursor"""
+    key = [item.created_at.isoformat(), item.id, direction]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor, None if it is not valid"""
+    try:
+        created_at, item_id, direction = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if direction not in ('next', 'prev'):
+            return None
+        return datetime.datetime.fromisoformat(created_at), int(item_id), direction
+    except (ValueError, TypeError, binascii.Error):
+        return None
+
+
+class RowPagination(SelectPagination):
+    """db.paginate returning plain rows instead of ORM objects"""
+
+    def _query_items(self):
+        select = self._query_args["select"].limit(self.per_page).offset(self._query_offset)
+        return list(self._query_args["session"].execute(select).all())
+
+
+@lru_cache(maxsize=None)
+def row_fields(model, schema):
+    """
+    (key, attribute) of every field of schema when they are all model columns
+    dumped as is (datetimes aside), so rows can be serialized without marshmallow.
+    None when the schema needs marshmallow.
+    """
+    columns = model.__mapper__.columns
+    result = []
+    for name, field in schema.dump_fields.items():
+        attribute = field.attribute or name
+        if attribute not in columns or not isinstance(field, (fields.Integer, fields.String, fields.DateTime)):
+            return None
+        if isinstance(field, fields.DateTime) and field.format not in (None, 'iso'):
+            return None
+        result.append((field.data_key or name, attribute))
+    return tuple(result)
+
+
+def select_rows(db_select, model, names):
+    """Select only the columns to dump, plus the ones pagination and validators need"""
+    attributes = [attribute for _, attribute in names]
+    attributes += [name for name in ('id', 'created_at', 'updated_at') if name not in attributes]
+    return db_select.with_only_columns(*[getattr(model, attribute) for attribute in attributes])
+
+
+def dump_rows(rows, names):
+    keys = [key for key, _ in names]
+    return [
+        {key: value.isoformat() if isinstance(value, datetime.datetime) else value for key, value in zip(keys, row)}
+        for row in rows
+    ]
+
+
+def page_url(req, **params):
+    """URL of another page of the current request, keeping its other query arguments"""
+    args = [(key, value) for key, value in req.args.items(multi=True) if key not in ('page', 'per_page', 'cursor')]
+    return "%s?%s" % (req.base_url, urlencode(args + list(params.items())))
+
+
+def dump_page(items, schema, model, names, links):
+    """
+    Response of a page of items with its links, 304 when the client has it already.
+    Each embedded collection comes with a has_more_<name> flag, it is capped to EXPAND_LIST_LIMIT objects.
+    """
+    response = dict(links)
+    more = {} if names else load_expanded(items, schema)
+    conditional_get(items, schema, extra=repr(sorted(response.items())) + repr(sorted(more.items())), model=model)
+    with timed('dump'):
+        response['data'] = dump_rows(items, names) if names else schema.dump(items, many=True)
+    for item, data in zip(items, response['data']):
+        for name, ids in more.items():
+            data[f'has_more_{name}'] = item.id in ids
+    return response
+
+
+def cursor_pagination(req, db_select, schema, per_page):
+    """Keyset pagination that seeks on (created_at, id) without counting rows"""
+    model = db_select.column_descriptions[0]['entity']
+    names = current_app.config.get('FAST_SERIALIZATION', True) and row_fields(model, schema)
+    key = tuple_(model.created_at, model.id)
+    cursor = decode_cursor(req.args.get('cursor', ''))
+
+    if cursor is None:
+        direction = 'next'
+        db_select = db_select.order_by(model.created_at, model.id)
+    else:
+        created_at, item_id, direction = cursor
+        if direction == 'next':
+            db_select = db_select.where(key > tuple_(created_at, item_id)).order_by(model.created_at, model.id)
+        else:
+            db_select = db_select.where(key < tuple_(created_at, item_id)).order_by(
+                model.created_at.desc(), model.id.desc())
+
+    if names:
+        results = db.session.execute(select_rows(db_select, model, names).limit(per_page + 1)).all()
+    else:
+        results = db.session.execute(db_select.limit(per_page + 1)).scalars().all()
+    has_more = len(results) > per_page
+    results = results[:per_page]
+    if direction == 'prev':
+        results.reverse()
+    has_next = has_more if direction == 'next' else True
+    has_prev = cursor is not None if direction == 'next' else has_more
+
+    links = {}
+    if results and has_next:
+        links['next'] = page_url(req, cursor=encode_cursor(results[-1], 'next'), per_page=per_page)
+    if results and has_prev:
+        links['prev'] = page_url(req, cursor=encode_cursor(results[0], 'prev'), per_page=per_page)
+    return dump_page(results, schema, model, names, links)
+
+
+def pagination(req, db_select, schema, order_by=None):
+    """
+    Paginate db_select in creation order, with keyset pagination when a cursor is passed.
+    A custom order_by, such as a search rank, is only paginated by offset.
+    """
     try:
         page = int(req.args.get("page"))
     except (ValueError, TypeError):
@@ -71,12 +385,20 @@ def pagination(req, db_select, schema):
     except (ValueError, TypeError):
         per_page = 20
 
-    results = db.paginate(db_select, page=page, per_page=per_page)
-    response = {
-        'data': schema.dump(results, many=True)
-    }
+    if 'cursor' in req.args and order_by is None:
+        return cursor_pagination(req, db_select, schema, max(per_page, 1))
+
+    model = db_select.column_descriptions[0]['entity']
+    db_select = db_select.order_by(*(order_by or (model.created_at, model.id)))
+    names = current_app.config.get('FAST_SERIALIZATION', True) and row_fields(model, schema)
+    if names:
+        results = RowPagination(select=select_rows(db_select, model, names), session=db.session(),
+                                page=page, per_page=per_page, max_per_page=None)
+    else:
+        results = db.paginate(db_select, page=page, per_page=per_page)
+    links = {}
     if results.has_next:
-        response['next'] = "%s?page=%s&per_page=%s" % (request.base_url, results.page + 1, results.per_page)
+        links['next'] = page_url(req, page=results.page + 1, per_page=results.per_page)
     if results.has_prev:
-        response['prev'] = "%s?page=%s&per_page=%s" % (request.base_url, results.page - 1, results.per_page)
-    return response
+        links['prev'] = page_url(req, page=results.page - 1, per_page=results.per_page)
+    return dump_page(results.items, schema, model, names, links)
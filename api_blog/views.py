@@ -1,9 +1,20 @@
 from flask.views import MethodView
-from flask import request, jsonify, g
+from flask import request, jsonify, g, current_app
 from marshmallow.exceptions import ValidationError
+from sqlalchemy.exc import IntegrityError
 
-from .utils import error_response, auth_required, pagination
+from .utils import (error_response, auth_required, pagination, expand_options, expanded_schema, conditional_get,
+                    json_response, read_replica, if_match_versions, item_etag)
 from .models import db
+from .cache import response_cache
+from .profiling import timed
+from .ratelimit import limiter
+
+
+def reference_deleted():
+    """Answer for a write whose referenced rows were deleted after missing_references checked them"""
+    db.session.rollback()
+    return error_response("The item references a row deleted meanwhile, please try again.", code=409)
 
 
 class DetailAPI(MethodView):
@@ -11,52 +22,76 @@ class DetailAPI(MethodView):
 
     def __init__(self, model, schema):
         self.model = model
-        self.schema = schema()
+        self.schema_class = schema
+        self.schema = expanded_schema(schema)
 
-    def _get_obj(self, id):
-        return db.session.get(self.model, id)
+    def _get_obj(self, id, options=None):
+        return db.session.get(self.model, id, options=options)
 
+    @response_cache.cached()
+    @limiter.limit('read')
+    @read_replica
     def get(self, id):
-        item = self._get_obj(id)
+        options, schema = expand_options(request, self.model, self.schema_class)
+        item = self._get_obj(id, options)
         if not item:
             return self.return_404()
 
-        data = self.schema.dump(item)
+        conditional_get([item], schema, single=True)
+        with timed('dump'):
+            data = schema.dump(item)
         return jsonify(data)
 
+    @limiter.limit('write')
     @auth_required
     def patch(self, id):
-        obj = self._get_obj(id)
-        if not obj:
-            return self.return_404()
-
-        if not obj.author_id == g.user.get('id'):
-            return error_response("You can not update this item.")
-
         author_id = request.json.get("author_id")
-        if author_id and not author_id == obj.author_id:
+        if author_id and not author_id == g.user.get('id'):
             return error_response("You can not change author.")
-
         try:
             data = self.schema.load(request.json, partial=True)
-            obj.update(data)
-            data = self.schema.dump(obj)
-            return jsonify(data)
         except ValidationError as e:
             return error_response(e.messages)
+        missing = self.model.missing_references({0: data})
+        if missing:
+            return error_response(missing[0])
 
+        # one UPDATE checks ownership and version, the current row is only read when it fails
+        try:
+            rows = self.model.update_returning(*self._write_criteria(id), **data)
+        except IntegrityError:
+            return reference_deleted()
+        if not rows:
+            return self._write_failed(id, "You can not update this item.")
+        response = jsonify(self.schema.dump(rows[0]))
+        response.headers['ETag'] = item_etag(rows[0], self.schema, self.model)
+        return response
+
+    @limiter.limit('write')
     @auth_required
     def delete(self, id):
-        obj = self._get_obj(id)
-        if not obj:
-            return self.return_404()
-
-        if not obj.author_id == g.user.get('id'):
-            return error_response("You can not delete this item.")
-
-        obj.delete()
+        if not self.model.delete_where(*self._write_criteria(id)):
+            return self._write_failed(id, "You can not delete this item.")
         return jsonify({'message': 'Deleted'}), 204
 
+    def _write_criteria(self, id):
+        criteria = [self.model.id == id, self.model.author_id == g.user.get('id')]
+        versions = if_match_versions()
+        if versions is not None:
+            criteria.append(self.model.version.in_(versions))
+        return criteria
+
+    def _write_failed(self, id, forbidden_message):
+        """Tell a missing item from one of another author, or one changed since the client read it"""
+        row = db.session.execute(
+            db.select(self.model.author_id, self.model.version).where(self.model.id == id)
+        ).one_or_none()
+        if row is None:
+            return self.return_404()
+        if not row.author_id == g.user.get('id'):
+            return error_response(forbidden_message, code=403)
+        return error_response("The item was changed since you read it, get it again.", code=412)
+
     def return_404(self):
         return error_response("Item does not exist", code=404)
 
@@ -66,28 +101,83 @@ class ListAPI(MethodView):
 
     def __init__(self, model, schema):
         self.model = model
-        self.schema = schema()
+        self.schema_class = schema
+        self.schema = expanded_schema(schema)
 
+    @response_cache.cached()
+    @limiter.limit('read')
+    @read_replica
     def get(self):
-        response = pagination(request, db.select(self.model), self.schema)
-        return jsonify(response)
+        options, schema = expand_options(request, self.model, self.schema_class, many=True)
+        response = pagination(request, db.select(self.model).options(*options), schema)
+        return json_response(response)
 
+    @limiter.limit('write')
     @auth_required
     def post(self):
         req_data = request.get_json()
         req_data['author_id'] = g.user.get('id')
         try:
             data = self.schema.load(req_data)
-            obj = self.model(**data)
-            obj.save()
-            data = self.schema.dump(obj)
-            return jsonify(data), 201
         except ValidationError as e:
             return error_response(e.messages)
+        # the author comes from the token, stateless mode trusts it without reading the users table
+        missing = self.model.missing_references({0: dict(data, author_id=None)})
+        if missing:
+            return error_response(missing[0])
+
+        obj = self.model(**data)
+        try:
+            obj.save()
+        except IntegrityError:
+            return reference_deleted()
+        data = self.schema.dump(obj)
+        return jsonify(data), 201
+
+
+class BulkAPI(MethodView):
+    init_every_request = False
+
+    def __init__(self, model, schema):
+        self.model = model
+        self.schema = expanded_schema(schema)
+
+    @limiter.limit('write')
+    @auth_required
+    def post(self):
+        req_data = request.get_json()
+        if not isinstance(req_data, list):
+            return error_response("Expected a list of items.")
+        max_items = current_app.config.get('BULK_MAX_ITEMS', 1000)
+        if len(req_data) > max_items:
+            return error_response(f"You can not create more than {max_items} items at once.", code=413)
+
+        author_id = g.user.get('id')
+        req_data = [dict(item, author_id=author_id) if isinstance(item, dict) else item for item in req_data]
+        try:
+            items = dict(enumerate(self.schema.load(req_data, many=True)))
+            errors = {}
+        except ValidationError as e:
+            errors = e.messages
+            items = {index: item for index, item in enumerate(e.valid_data) if index not in errors}
+        # a missing post would otherwise fail the whole insert on its foreign key
+        missing = self.model.missing_references(items)
+        errors.update(missing)
+        items = [item for index, item in items.items() if index not in missing]
+        if not items:
+            return jsonify({'error': errors or "Expected a list of items."}), 400
+
+        try:
+            ids = self.model.bulk_create(items)
+        except IntegrityError:
+            return reference_deleted()
+        return jsonify({'ids': ids, 'errors': errors}), 201
 
 
 def register_api(app, model, schema, name):
     item = DetailAPI.as_view(f"{name}-detail", model, schema)
     group = ListAPI.as_view(f"{name}-list", model, schema)
+    bulk = BulkAPI.as_view(f"{name}-bulk", model, schema)
     app.add_url_rule(f"/{name}/<int:id>", view_func=item)
     app.add_url_rule(f"/{name}/", view_func=group)
+    app.add_url_rule(f"/{name}/bulk", view_func=bulk)
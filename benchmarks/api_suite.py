@@ -0,0 +1,195 @@
+"""
+Throughput and p50/p99 latency of the API hot paths on a large seeded database.
+
+    python -m benchmarks.api_suite [--database-url URL] [--posts N] [--comments N] [--output FILE]
+
+The database (a SQLite file under /tmp by default, or a Postgres URL such as the
+flask_db container of docker-compose.yml) is seeded once with a fixed random seed and
+reused by later runs with the same sizes, pass --reseed to rebuild it.
+Requests go through the WSGI app in process, so the numbers exclude the HTTP server.
+The results are written as JSON to benchmarks/results/<commit>.json,
+compare two of them with `python -m benchmarks.compare`.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import threading
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, insert, inspect, text, make_url
+
+from api_blog import create_app
+from api_blog.config import app_config, Prod
+from api_blog.hashing import _generate_hash
+from api_blog.models import db, User
+from api_blog.utils import encode_cursor
+from benchmarks.load_test import percentile
+from benchmarks.query_plans import seed
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+PASSWORD = 'benchmark'
+START = datetime.datetime(2020, 1, 1)
+SCENARIOS = ('posts_deep_page', 'posts_deep_cursor', 'post_detail', 'post_comments', 'login', 'create_post')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def prepare(url, users, posts, comments, reseed):
+    """Seed the database unless it already holds a dataset of these sizes"""
+    engine = create_engine(url)
+    with engine.connect() as conn:
+        seeded = inspect(conn).has_table('comments') and conn.execute(
+            text('SELECT count(*) FROM comments')).scalar() == comments and conn.execute(
+            text('SELECT count(*) FROM blog_posts')).scalar() == posts
+    if seeded and not reseed:
+        engine.dispose()
+        return
+
+    print(f'Seeding {posts} posts and {comments} comments into {engine.url}')
+    random.seed(42)
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    seed(engine, users, posts, comments)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{
+            'id': users + 1, 'username': 'benchmark', 'email': 'benchmark@example.com',
+            'password_hash': _generate_hash(PASSWORD, int(os.getenv('BCRYPT_LOG_ROUNDS', 10))), 'created_at': START,
+        }])
+        conn.execute(text(
+            'UPDATE blog_posts SET '
+            'comment_count = (SELECT count(*) FROM comments WHERE comments.post_id = blog_posts.id), '
+            'last_comment_at = (SELECT max(created_at) FROM comments WHERE comments.post_id = blog_posts.id)'
+        ))
+        if engine.dialect.name == 'postgresql':
+            # the rows were inserted with explicit ids
+            for table in ('users', 'blog_posts', 'comments'):
+                conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), max(id)) FROM {table}"))
+        conn.exec_driver_sql('ANALYZE')
+    engine.dispose()
+
+
+def scenarios(client, posts, per_page):
+    """name -> function sending one request, returns the status code"""
+    response = client.post('/users/login', json={'email': 'benchmark@example.com', 'password': PASSWORD})
+    token = response.get_json()['jwt_token']
+    deep_page = posts // per_page - 10
+    deep_cursor = encode_cursor(
+        SimpleNamespace(created_at=START + datetime.timedelta(minutes=posts - 10 * per_page), id=posts - 10 * per_page),
+        'next')
+
+    def post_id():
+        return random.randint(1, posts)
+
+    return {
+        'posts_deep_page': lambda: client.get(f'/posts/?page={deep_page}&per_page={per_page}').status_code,
+        'posts_deep_cursor': lambda: client.get(f'/posts/?cursor={deep_cursor}&per_page={per_page}').status_code,
+        'post_detail': lambda: client.get(f'/posts/{post_id()}').status_code,
+        'post_comments': lambda: client.get(f'/post-comments/{post_id()}').status_code,
+        'login': lambda: client.post(
+            '/users/login', json={'email': 'benchmark@example.com', 'password': PASSWORD}).status_code,
+        'create_post': lambda: client.post(
+            '/posts/', json={'title': 'Benchmark', 'content': 'Benchmark post'}, headers={'api-token': token}
+        ).status_code,
+    }
+
+
+def measure(app, name, concurrency, duration, warmup, posts, per_page):
+    latencies, errors = [], []
+
+    def worker(deadline):
+        run = scenarios(app.test_client(), posts, per_page)[name]
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            status = run()
+            elapsed = time.perf_counter() - started
+            if status >= 400:
+                errors.append(status)
+            elif time.perf_counter() > deadline - duration:
+                latencies.append(elapsed)
+
+    # requests finished during the warmup are not recorded
+    deadline = time.perf_counter() + warmup + duration
+    threads = [threading.Thread(target=worker, args=(deadline,)) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput_rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--comments', type=int, default=1000000)
+    parser.add_argument('--per-page', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10, help='Seconds measured per scenario.')
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='Run only these scenarios.')
+    parser.add_argument('--response-cache', action='store_true', help='Keep the response cache on.')
+    parser.add_argument('--reseed', action='store_true')
+    parser.add_argument('--output', help='Defaults to benchmarks/results/<commit>.json')
+    args = parser.parse_args()
+
+    url = args.database_url or f'sqlite:////tmp/api_blog_bench_{args.posts}_{args.comments}.db'
+    prepare(url, args.users, args.posts, args.comments, args.reseed)
+
+    class Benchmark(Prod):
+        SQLALCHEMY_DATABASE_URI = url
+        JWT_SECRET_KEY = 'benchmark'
+        RESPONSE_CACHE_ENABLED = args.response_cache
+        RATE_LIMIT_ENABLED = False
+        CONCURRENCY_LIMITS = {}
+    app_config['benchmark'] = Benchmark
+    app = create_app('benchmark')
+
+    names = args.scenario or SCENARIOS
+    results = {}
+    for name in names:
+        results[name] = measure(app, name, args.concurrency, args.duration, args.warmup, args.posts, args.per_page)
+        print(f'{name:20} {results[name]["throughput_rps"]:>8} rps  '
+              f'p50 {results[name]["p50_ms"]:>8} ms  p99 {results[name]["p99_ms"]:>8} ms  '
+              f'errors {results[name]["errors"]}')
+    # posts created by the create_post scenario would change the dataset of the next run
+    with app.app_context():
+        db.session.execute(text('DELETE FROM blog_posts WHERE id > :posts'), {'posts': args.posts})
+        db.session.commit()
+    app.extensions['password_hasher'].shutdown()
+
+    commit = git_commit()
+    output = args.output or os.path.join(RESULTS_DIR, f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as results_file:
+        json.dump({
+            'commit': commit,
+            'date': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'database': make_url(url).get_backend_name(),
+            'dataset': {'users': args.users, 'posts': args.posts, 'comments': args.comments},
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'results': results,
+        }, results_file, indent=2)
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
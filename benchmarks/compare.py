@@ -0,0 +1,56 @@
+"""
+Compare two result files of benchmarks.api_suite, for example the results of two commits.
+
+    python -m benchmarks.compare benchmarks/results/<old>.json benchmarks/results/<new>.json [--threshold 10]
+
+Exits with status 1 when a scenario got slower (p50 or p99) or slower to serve
+(throughput) by more than threshold percent.
+"""
+import argparse
+import json
+import sys
+
+# metric -> True when a higher value is better
+METRICS = {'throughput_rps': True, 'p50_ms': False, 'p99_ms': False}
+
+
+def change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / old * 100
+
+
+def compare(old, new, threshold):
+    """Print the table of changes and return the list of regressions"""
+    regressions = []
+    print(f'{old["commit"]} -> {new["commit"]}')
+    if old.get('dataset') != new.get('dataset') or old.get('database') != new.get('database'):
+        print('Warning: the results were measured on different datasets')
+    for name in sorted(set(old['results']) & set(new['results'])):
+        cells = []
+        for metric, higher_is_better in METRICS.items():
+            before, after = old['results'][name][metric], new['results'][name][metric]
+            delta = change(before, after)
+            worse = -delta if higher_is_better else delta
+            if worse > threshold:
+                regressions.append((name, metric, delta))
+            cells.append(f'{metric} {before:>9} -> {after:>9} ({delta:+6.1f}%)')
+        print(f'  {name:20} ' + '  '.join(cells))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10, help='Percent change reported as a regression.')
+    args = parser.parse_args()
+    with open(args.old) as old_file, open(args.new) as new_file:
+        regressions = compare(json.load(old_file), json.load(new_file), args.threshold)
+    for name, metric, delta in regressions:
+        print(f'Regression: {name} {metric} {delta:+.1f}%')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
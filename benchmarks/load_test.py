@@ -0,0 +1,80 @@
+"""
+Closed-loop HTTP load test: N concurrent clients request the same URL for a fixed time.
+
+    python -m benchmarks.load_test http://localhost:4000/posts/ --concurrency 32 --duration 10
+
+Run it once against `flask run` and once against `gunicorn -c gunicorn.conf.py wsgi:app`
+to compare the development server with the production profile.
+"""
+import argparse
+import http.client
+import json
+import statistics
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def worker(url, deadline, latencies, errors):
+    parts = urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors.append(response.status)
+            if response.getheader('Connection', '').lower() == 'close':
+                conn.close()
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(url, concurrency, duration):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=worker, args=(url, deadline, latencies, errors)) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'url': url,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 2) if latencies else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('url')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+    print(json.dumps(run(args.url, args.concurrency, args.duration), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Query plans and timings of the hot API queries before and after the lookup indexes.
+
+    python -m benchmarks.query_plans [--database-url URL] [--posts N] [--comments N]
+
+By default a throwaway SQLite file is used, pass a Postgres URL to see its plans.
+The tables are dropped and recreated in that database.
+"""
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert, select, tuple_, func
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from api_blog.models import Base, User, BlogPost, Comment
+
+
+class explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(explain)
+def visit_explain(element, compiler, **kw):
+    prefix = 'EXPLAIN QUERY PLAN ' if compiler.dialect.name == 'sqlite' else 'EXPLAIN '
+    return prefix + compiler.process(element.statement, **kw)
+
+
+def seed(engine, users, posts, comments):
+    start = datetime.datetime(2020, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com', 'created_at': start}
+            for i in range(1, users + 1)
+        ])
+        conn.execute(insert(BlogPost), [
+            {'id': i, 'title': f'Post {i}', 'content': 'Content', 'author_id': random.randint(1, users),
+             'created_at': start + datetime.timedelta(minutes=i)}
+            for i in range(1, posts + 1)
+        ])
+        batch = 50000
+        for offset in range(0, comments, batch):
+            conn.execute(insert(Comment), [
+                {'id': i, 'content': 'Comment', 'author_id': random.randint(1, users),
+                 'post_id': random.randint(1, posts), 'created_at': start + datetime.timedelta(seconds=i)}
+                for i in range(offset + 1, min(offset + batch, comments) + 1)
+            ])
+
+
+def queries(posts):
+    post_id = posts // 2
+    deep_page = posts // 40
+    cursor = tuple_(datetime.datetime(2020, 1, 1) + datetime.timedelta(minutes=posts // 2), posts // 2)
+    return {
+        'post comments (first page)': select(Comment).where(Comment.post_id == post_id)
+        .order_by(Comment.created_at, Comment.id).limit(20),
+        'post comments (count)': select(func.count()).select_from(Comment).where(Comment.post_id == post_id),
+        'posts (offset page %s)' % deep_page: select(BlogPost).order_by(BlogPost.created_at, BlogPost.id)
+        .limit(20).offset(20 * deep_page),
+        'posts (keyset page)': select(BlogPost).where(tuple_(BlogPost.created_at, BlogPost.id) > cursor)
+        .order_by(BlogPost.created_at, BlogPost.id).limit(21),
+        'comments by author': select(Comment).where(Comment.author_id == 7).limit(20),
+    }
+
+
+def report(engine, statements, repeat):
+    with engine.connect() as conn:
+        for name, statement in statements.items():
+            plan = [' '.join(str(col) for col in row) for row in conn.execute(explain(statement))]
+            started = time.perf_counter()
+            for _ in range(repeat):
+                conn.execute(statement).all()
+            elapsed = (time.perf_counter() - started) / repeat * 1000
+            print(f'  {name}: {elapsed:.2f} ms')
+            for line in plan:
+                print(f'      {line}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--comments', type=int, default=500000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    sqlite_file = None
+    if not args.database_url:
+        sqlite_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+    url = args.database_url or 'sqlite:///%s' % sqlite_file
+    engine = create_engine(url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(conn)
+
+    print(f'Seeding {args.posts} posts and {args.comments} comments into {engine.url}')
+    seed(engine, args.users, args.posts, args.comments)
+    statements = queries(args.posts)
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql('ANALYZE')
+    print('Without indexes:')
+    report(engine, statements, args.repeat)
+
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn)
+        conn.exec_driver_sql('ANALYZE')
+    print('With indexes:')
+    report(engine, statements, args.repeat)
+
+    engine.dispose()
+    if sqlite_file:
+        os.remove(sqlite_file)
+
+
+if __name__ == '__main__':
+    main()
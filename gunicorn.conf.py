@@ -0,0 +1,34 @@
+"""Production serving profile, every setting can be tuned from the environment"""
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:4000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('WEB_THREADS', 4))
+worker_class = 'gthread' if threads > 1 else 'sync'
+# Import the app once in the master so workers fork with it already loaded
+preload_app = True
+timeout = int(os.getenv('WEB_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER', 0))
+accesslog = os.getenv('WEB_ACCESS_LOG', '-')
+
+
+def post_fork(server, worker):
+    # Connections opened while preloading must not be shared between processes
+    from api_blog.models import db
+    app = worker.app.wsgi()
+    with app.app_context():
+        db.engine.dispose(close=False)
+    for engine in app.extensions['replicas'].engines:
+        engine.dispose(close=False)
+
+
+def worker_exit(server, worker):
+    app = worker.app.wsgi()
+    app.extensions['password_hasher'].shutdown()
+    with app.app_context():
+        from api_blog.models import db
+        db.engine.dispose()
@@ -0,0 +1,37 @@
+"""indexes for the hot lookup columns and the pagination order
+
+Revision ID: 8c2d4e6f7a81
+Revises: 3f1a2b4c5d6e
+Create Date: 2026-10-18 18:25:02.418215
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8c2d4e6f7a81'
+down_revision = '3f1a2b4c5d6e'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_users_created_at_id', 'users', ['created_at', 'id']),
+    ('ix_blog_posts_created_at_id', 'blog_posts', ['created_at', 'id']),
+    ('ix_blog_posts_author_id', 'blog_posts', ['author_id']),
+    ('ix_comments_post_id_created_at_id', 'comments', ['post_id', 'created_at', 'id']),
+    ('ix_comments_created_at_id', 'comments', ['created_at', 'id']),
+    ('ix_comments_author_id', 'comments', ['author_id']),
+]
+
+
+def upgrade():
+    # CONCURRENTLY on Postgres keeps the tables writable while the indexes build
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,45 @@
+"""ON DELETE CASCADE from comments to blog_posts, deleted_at on blog_posts
+
+Revision ID: a8d0f2b4c6e7
+Revises: f6b8d0e2a4c5
+Create Date: 2026-10-18 23:02:41.730912
+
+The foreign key of SQLite was created without a name, a naming convention lets the
+batch operation find it. Deleting the posts of a SQLite database written before
+foreign keys were enforced can leave orphaned comments, remove them with
+`flask cleanup-comments --orphans`.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8d0f2b4c6e7'
+down_revision = 'f6b8d0e2a4c5'
+branch_labels = None
+depends_on = None
+
+FK_NAME = 'comments_post_id_fkey'
+# the name Postgres gave the foreign key, and the name batch mode gives the unnamed one of SQLite
+NAMING_CONVENTION = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+
+def upgrade():
+    with op.batch_alter_table('comments', schema=None, naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_constraint(FK_NAME, type_='foreignkey')
+        batch_op.create_foreign_key(FK_NAME, 'blog_posts', ['post_id'], ['id'], ondelete='CASCADE')
+
+    with op.batch_alter_table('blog_posts', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_blog_posts_deleted_at', 'blog_posts', ['deleted_at'],
+                    postgresql_where=sa.text('deleted_at IS NOT NULL'), sqlite_where=sa.text('deleted_at IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_blog_posts_deleted_at', table_name='blog_posts')
+    # not in a batch: SQLite would copy blog_posts to a new table and lose its search triggers
+    op.drop_column('blog_posts', 'deleted_at')
+
+    with op.batch_alter_table('comments', schema=None) as batch_op:
+        batch_op.drop_constraint(FK_NAME, type_='foreignkey')
+        batch_op.create_foreign_key(FK_NAME, 'blog_posts', ['post_id'], ['id'])
@@ -0,0 +1,31 @@
+"""updated_at on every table for conditional GET
+
+Revision ID: b7e9a1c3d5f2
+Revises: 8c2d4e6f7a81
+Create Date: 2026-10-18 19:02:41.733590
+
+Existing rows keep updated_at NULL, readers fall back to created_at.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e9a1c3d5f2'
+down_revision = '8c2d4e6f7a81'
+branch_labels = None
+depends_on = None
+
+TABLES = ['users', 'blog_posts', 'comments']
+
+
+def upgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    for table in reversed(TABLES):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('updated_at')
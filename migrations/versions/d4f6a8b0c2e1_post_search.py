@@ -0,0 +1,63 @@
+"""full text search over blog post titles and content
+
+Revision ID: d4f6a8b0c2e1
+Revises: b7e9a1c3d5f2
+Create Date: 2026-10-18 20:14:09.512301
+
+Postgres gets a generated tsvector column (the ALTER rewrites blog_posts) and a GIN
+index built concurrently. SQLite gets an FTS5 table kept in sync by triggers.
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4f6a8b0c2e1'
+down_revision = 'b7e9a1c3d5f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute(
+            "ALTER TABLE blog_posts ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+            "setweight(to_tsvector('english', coalesce(content, '')), 'B')) STORED"
+        )
+        with op.get_context().autocommit_block():
+            op.execute("CREATE INDEX CONCURRENTLY ix_blog_posts_search ON blog_posts USING GIN (search_vector)")
+    elif dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE blog_posts_fts USING fts5("
+            "title, content, content='blog_posts', content_rowid='id', tokenize='porter unicode61')"
+        )
+        op.execute(
+            "CREATE TRIGGER blog_posts_fts_insert AFTER INSERT ON blog_posts BEGIN "
+            "INSERT INTO blog_posts_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END"
+        )
+        op.execute(
+            "CREATE TRIGGER blog_posts_fts_delete AFTER DELETE ON blog_posts BEGIN "
+            "INSERT INTO blog_posts_fts(blog_posts_fts, rowid, title, content) "
+            "VALUES ('delete', old.id, old.title, old.content); END"
+        )
+        op.execute(
+            "CREATE TRIGGER blog_posts_fts_update AFTER UPDATE OF title, content ON blog_posts BEGIN "
+            "INSERT INTO blog_posts_fts(blog_posts_fts, rowid, title, content) "
+            "VALUES ('delete', old.id, old.title, old.content); "
+            "INSERT INTO blog_posts_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END"
+        )
+        # index the posts written before this migration
+        op.execute("INSERT INTO blog_posts_fts(blog_posts_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_blog_posts_search")
+        op.execute("ALTER TABLE blog_posts DROP COLUMN search_vector")
+    elif dialect == 'sqlite':
+        for trigger in ('blog_posts_fts_update', 'blog_posts_fts_delete', 'blog_posts_fts_insert'):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        op.execute("DROP TABLE IF EXISTS blog_posts_fts")
@@ -0,0 +1,36 @@
+"""comment_count and last_comment_at on blog_posts
+
+Revision ID: e5a7c9d1f3b4
+Revises: d4f6a8b0c2e1
+Create Date: 2026-10-18 20:52:37.104825
+
+The counters of existing posts are filled from the comments table,
+`flask repair-comment-counts` does the same in batches on a live database.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a7c9d1f3b4'
+down_revision = 'd4f6a8b0c2e1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('blog_posts', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('last_comment_at', sa.DateTime(), nullable=True))
+
+    op.execute(
+        "UPDATE blog_posts SET "
+        "comment_count = (SELECT count(*) FROM comments WHERE comments.post_id = blog_posts.id), "
+        "last_comment_at = (SELECT max(created_at) FROM comments WHERE comments.post_id = blog_posts.id)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('blog_posts', schema=None) as batch_op:
+        batch_op.drop_column('last_comment_at')
+        batch_op.drop_column('comment_count')
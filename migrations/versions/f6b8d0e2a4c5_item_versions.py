@@ -0,0 +1,30 @@
+"""version on blog_posts and comments for optimistic concurrency
+
+Revision ID: f6b8d0e2a4c5
+Revises: e5a7c9d1f3b4
+Create Date: 2026-10-18 22:14:09.518230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6b8d0e2a4c5'
+down_revision = 'e5a7c9d1f3b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('blog_posts', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+    with op.batch_alter_table('comments', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    # not in a batch: SQLite would copy blog_posts to a new table and lose its search triggers
+    op.drop_column('comments', 'version')
+    op.drop_column('blog_posts', 'version')
@@ -0,0 +1,6 @@
+"""WSGI entry point: gunicorn -c gunicorn.conf.py wsgi:app"""
+import os
+
+from api_blog import create_app
+
+app = create_app(os.getenv('BLOG_ENV_NAME', 'prod'))